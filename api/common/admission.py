@@ -0,0 +1,127 @@
+import re
+from asyncio import Semaphore
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from fastapi import HTTPException, status
+from fastapi.responses import ORJSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .settings import api_settings
+
+BUSY_DETAIL = "The server is busy. Try again later."
+
+class AdmissionController:
+    """
+    Per worker concurrency budget for an expensive kind of work.
+
+    At most `concurrency` requests run at once and at most `queue_size`
+    wait for a slot. Anything over that is shed with a 503 right away,
+    instead of piling up behind the threadpool until every request,
+    cheap reads included, times out.
+    """
+    def __init__(self, name: str, concurrency: int, queue_size: int, retry_after: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._semaphore = Semaphore(concurrency)
+
+    def is_saturated(self) -> bool:
+        return self._semaphore.locked() and self.waiting >= self.queue_size
+
+    def get_rejection_headers(self) -> dict[str, str]:
+        return {
+            "Retry-After": str(self.retry_after)
+        }
+
+    @asynccontextmanager
+    async def admit(self) -> AsyncIterator[None]:
+        if self.is_saturated():
+            self.rejected += 1
+            raise HTTPException(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=BUSY_DETAIL,
+                headers=self.get_rejection_headers()
+            )
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._semaphore.release()
+
+    async def __call__(self) -> AsyncIterator[None]:
+        # Lets the controller be used as a route dependency.
+        async with self.admit():
+            yield
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected
+        }
+
+class AdmissionMiddleware:
+    """
+    Sheds requests for a saturated AdmissionController before their body
+    is read, which for uploads is most of the work the route dependency
+    comes too late to save. The dependency still admits the requests let
+    through, racing requests included.
+
+    `rules` are (method, path pattern, controller) triples.
+    """
+    def __init__(self, app: ASGIApp, rules: list[tuple[str, str, AdmissionController]] = []):
+        self.app = app
+        self.rules = [(method, re.compile(pattern), controller) for method, pattern, controller in rules]
+
+    def get_controller(self, method: str, path: str) -> AdmissionController | None:
+        for rule_method, pattern, controller in self.rules:
+            if rule_method == method and pattern.search(path):
+                return controller
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            controller = self.get_controller(scope["method"], scope["path"])
+            if controller and controller.is_saturated():
+                controller.rejected += 1
+                response = ORJSONResponse(
+                    {"detail": BUSY_DETAIL},
+                    status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers=controller.get_rejection_headers()
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+image_processing = AdmissionController(
+    "image_processing",
+    api_settings.image_processing_concurrency,
+    api_settings.image_processing_queue_size,
+    api_settings.admission_retry_after
+)
+password_hashing = AdmissionController(
+    "password_hashing",
+    api_settings.password_hashing_concurrency,
+    api_settings.password_hashing_queue_size,
+    api_settings.admission_retry_after
+)
+thumbnail_variants = AdmissionController(
+    "thumbnail_variants",
+    api_settings.thumbnail_variant_concurrency,
+    api_settings.thumbnail_variant_queue_size,
+    api_settings.admission_retry_after
+)
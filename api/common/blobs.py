@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import sleep
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from .db import db_blobs
+from .paths import IMAGES_PATH, get_image_file_name
+from .storage import storage
+from .thumbnail_cache import delete_thumbnails
+
+# How long a release has to delete a blob's files before acquire_blob
+# stops waiting for it and takes the blob back.
+DELETION_LEASE = timedelta(seconds=60)
+
+def acquire_blob(path: Path, hash: str, type_extension: str):
+    """
+    Moves the file at `path` into the content-addressed blob `hash`,
+    adding a reference to it. Identical content may already be stored,
+    in which case the rename replaces it with the same bytes.
+    """
+    while True:
+        now = datetime.now(timezone.utc)
+        try:
+            db_blobs.update_one({
+                "_id": hash,
+                "$or": [
+                    {"deletion_lease_expires_on": None},
+                    {"deletion_lease_expires_on": {"$lt": now}}
+                ]
+            }, {
+                "$inc": {
+                    "references": 1
+                },
+                "$unset": {
+                    "deletion_lease_expires_on": ""
+                },
+                "$setOnInsert": {
+                    "type_extension": type_extension
+                }
+            }, upsert=True)
+            break
+        except DuplicateKeyError:
+            # Being deleted by release_blob, putting the file now would
+            # only have it deleted too.
+            sleep(0.1)
+    storage.put(path, IMAGES_PATH, get_image_file_name(None, type_extension, hash))
+
+def release_blob(hash: str, type_extension: str):
+    """
+    Drops a reference to the blob `hash`, deleting it and its
+    thumbnail once nothing references it anymore.
+    """
+    blob_dict = db_blobs.find_one_and_update({
+        "_id": hash
+    }, {
+        "$inc": {
+            "references": -1
+        }
+    }, return_document=ReturnDocument.AFTER)
+    # Without a blob, the file may be someone else's to put back.
+    if not blob_dict or blob_dict["references"] > 0:
+        return
+    # Kept until its files are gone, so acquire_blob waits for them.
+    deletion_lease_expires_on = datetime.now(timezone.utc) + DELETION_LEASE
+    if db_blobs.update_one({
+        "_id": hash,
+        "references": {"$lte": 0},
+        "deletion_lease_expires_on": None
+    }, {
+        "$set": {
+            "deletion_lease_expires_on": deletion_lease_expires_on
+        }
+    }).modified_count == 0:
+        return
+    file_name = get_image_file_name(None, type_extension, hash)
+    storage.delete(IMAGES_PATH, file_name)
+    delete_thumbnails(file_name)
+    db_blobs.delete_one({
+        "_id": hash,
+        "deletion_lease_expires_on": deletion_lease_expires_on
+    })
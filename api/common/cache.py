@@ -0,0 +1,177 @@
+import os
+import socket
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock, Thread
+from time import monotonic, sleep
+from traceback import print_exception
+from typing import Any, Callable, Hashable
+
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+# Invalidates every key.
+ALL_KEYS = "*"
+
+
+class LRUCache:
+    """
+    Thread safe, size bounded LRU cache whose entries expire after `ttl`
+    seconds. A `max_size` of 0 disables it.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Bumped by every invalidation, see `set`.
+        self.generation = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, generation: int | None = None):
+        """
+        Stores `value`, unless something was invalidated since `generation`
+        was read, since `value` might have been loaded before that.
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self.generation += 1
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+
+class InvalidationBus:
+    """
+    Carries cache invalidations between server workers. Keys are strings,
+    `subscribe` registers the callback run for invalidations published
+    by other workers. This one doesn't reach any, for single worker setups.
+    """
+    def subscribe(self, callback: Callable[[str], None]):
+        pass
+
+    def publish(self, key: str):
+        pass
+
+    def close(self):
+        pass
+
+
+class LocalInvalidationBus(InvalidationBus):
+    """
+    Invalidations between workers on the same machine, over Unix datagram
+    sockets. Every worker binds one socket in `directory` and publishing
+    sends to all the others.
+    """
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.directory.mkdir(exist_ok=True)
+        self.path = directory / f"{os.getpid()}.sock"
+        self.path.unlink(True)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(str(self.path))
+
+    def subscribe(self, callback: Callable[[str], None]):
+        def receive():
+            while True:
+                try:
+                    message = self._socket.recv(4096)
+                except OSError:
+                    # Closed on shutdown.
+                    return
+                try:
+                    callback(message.decode("utf-8"))
+                except Exception as e:
+                    print_exception(e)
+        Thread(target=receive, daemon=True).start()
+
+    def publish(self, key: str):
+        for path in self.directory.glob("*.sock"):
+            if path == self.path:
+                continue
+            try:
+                self._socket.sendto(key.encode("utf-8"), str(path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a worker that's gone.
+                path.unlink(True)
+            except OSError:
+                # The other worker's queue is full, its entries expire anyway.
+                pass
+
+    def close(self):
+        self._socket.close()
+        self.path.unlink(True)
+
+
+class ChangeStreamInvalidationBus(InvalidationBus):
+    """
+    Invalidations from a MongoDB change stream of `collection`, which reach
+    every worker on every machine, including writes from scripts. Requires
+    a replica set. Publishing is a no-op since the writes are the messages.
+    """
+    def __init__(self, collection: Collection):
+        self.collection = collection
+        self._closed = False
+
+    def subscribe(self, callback: Callable[[str], None]):
+        def watch():
+            while not self._closed:
+                try:
+                    with self.collection.watch([
+                        {"$match": {"operationType": {"$in": ["update", "replace", "delete"]}}}
+                    ]) as stream:
+                        for change in stream:
+                            callback(str(change["documentKey"]["_id"]))
+                            if self._closed:
+                                return
+                except PyMongoError as e:
+                    print_exception(e)
+                # Changes might have been missed while disconnected.
+                callback(ALL_KEYS)
+                sleep(5)
+        Thread(target=watch, daemon=True).start()
+
+    def close(self):
+        self._closed = True
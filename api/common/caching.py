@@ -0,0 +1,83 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from hashlib import blake2b
+from time import time
+
+from fastapi import Response, status
+from starlette.datastructures import Headers
+
+from ..models.images import ImageInDB
+
+DEFAULT_MAX_AGE = 86400
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DEFAULT_CACHE_CONTROL = f"public, max-age={DEFAULT_MAX_AGE}"
+
+# Headers a 304 must repeat from the full response.
+NOT_MODIFIED_HEADERS = ("cache-control", "content-location", "etag", "expires", "last-modified", "vary")
+
+def get_file_etag(image: ImageInDB, variant: str = "") -> str:
+    """
+    Strong ETag for the stored file of `image` (or one of its `variant`s,
+    like thumbnails). Changes whenever locking, rekeying or unlocking
+    rewrites the file.
+    """
+    version = image.file.hash or (image.file.nonce.hex() if image.file.nonce else "")
+    parts = [
+        str(image.id),
+        image.file.type_extension,
+        str(image.lock.version.value) if image.lock.is_locked else "",
+        version,
+        variant
+    ]
+    return '"{}"'.format(blake2b(":".join(parts).encode("utf-8"), digest_size=16).hexdigest())
+
+def get_file_last_modified(image: ImageInDB) -> datetime:
+    # bson's UTC isn't datetime's, which HTTP date formatting insists on.
+    return (image.file.modified_on or image.created_on).astimezone(timezone.utc)
+
+def get_cache_control(image: ImageInDB, variant: str = "", expires: int | None = None) -> str:
+    """
+    Anything fetched through a signed URL (`expires`) may be cached by
+    CDNs, the URL being the permission, but not past the signature.
+    Private images fetched otherwise are kept out of shared caches.
+    """
+    if expires is not None:
+        return f"public, max-age={max(0, min(DEFAULT_MAX_AGE, expires - int(time())))}"
+    if image.is_private:
+        return f"private, max-age={DEFAULT_MAX_AGE}"
+    # Unlocked originals never change under the same id and extension.
+    return IMMUTABLE_CACHE_CONTROL if not image.lock.is_locked and not variant else DEFAULT_CACHE_CONTROL
+
+def get_file_cache_headers(image: ImageInDB, variant: str = "", expires: int | None = None) -> dict[str, str]:
+    return {
+        "Cache-Control": get_cache_control(image, variant, expires),
+        "ETag": get_file_etag(image, variant),
+        "Last-Modified": format_datetime(get_file_last_modified(image), usegmt=True)
+    }
+
+def is_not_modified(request_headers: Headers, etag: str, last_modified: datetime) -> bool:
+    """
+    Evaluates `If-None-Match` and, in its absence, `If-Modified-Since`.
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return True
+        # Weak comparison, as required for If-None-Match.
+        return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            return False
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+def not_modified_response(headers: dict[str, str]) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={
+        key: value for key, value in headers.items() if key.lower() in NOT_MODIFIED_HEADERS
+    })
@@ -0,0 +1,190 @@
+import re
+import zlib
+from mimetypes import guess_type
+from os import stat_result
+
+import brotli
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Compressed already, or random like encrypted files.
+INCOMPRESSIBLE_TYPES = re.compile(
+    r"^(image/(?!svg)|video/|audio/|font/woff|application/(octet-stream|zip|gzip|x-brotli|pdf))"
+)
+
+
+def get_accepted_encoding(headers: Headers) -> str | None:
+    qualities = {}
+    for coding in headers.get("accept-encoding", "").lower().split(","):
+        name, *parameters = coding.split(";")
+        quality = 1.0
+        for parameter in parameters:
+            parameter_name, _, value = parameter.partition("=")
+            if parameter_name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        qualities[name.strip()] = quality
+    # Codings not listed by name get the quality of *, if any.
+    default_quality = qualities.get("*", 0)
+    # The client's preference first, then Brotli's smaller output.
+    encoding, quality = max(
+        [(encoding, qualities.get(encoding, default_quality)) for encoding in ("br", "gzip")],
+        key=lambda item: item[1]
+    )
+    return encoding if quality > 0 else None
+
+def add_vary(headers: MutableHeaders, value: str):
+    if value.lower() not in headers.get("vary", "").lower():
+        headers.add_vary_header(value)
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses with Brotli, or gzip for clients without it.
+    Responses that are smaller than `minimum_size`, of an incompressible
+    type, already encoded or partial are sent as they are.
+
+    `levels` are (path pattern, level) pairs, the first one matching the
+    request path sets the level (0 to 11, 0 disables compression),
+    otherwise it's `default_level`. gzip levels are capped at 9.
+    """
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 512,
+        default_level: int = 4,
+        levels: list[tuple[str, int]] = []
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.default_level = default_level
+        self.levels = [(re.compile(pattern), level) for pattern, level in levels]
+
+    def get_level(self, path: str) -> int:
+        for pattern, level in self.levels:
+            if pattern.search(path):
+                return level
+        return self.default_level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        level = self.get_level(scope["path"])
+        if level <= 0:
+            await self.app(scope, receive, send)
+            return
+        responder = CompressionResponder(
+            send,
+            get_accepted_encoding(Headers(scope=scope)),
+            level,
+            self.minimum_size
+        )
+        await self.app(scope, receive, responder.send)
+
+
+class CompressionResponder:
+    def __init__(self, send: Send, encoding: str | None, level: int, minimum_size: int):
+        self._send = send
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self.start_message: Message | None = None
+        # None until decided, then whether bodies are compressed.
+        self.compressing: bool | None = None
+        self.buffer = b""
+        self.compressor = None
+
+    def is_compressible(self, headers: Headers) -> bool:
+        return (
+            self.start_message["status"] not in (204, 206, 304)
+            and "content-encoding" not in headers
+            and "content-range" not in headers
+            and "no-transform" not in headers.get("cache-control", "")
+            and not INCOMPRESSIBLE_TYPES.match(headers.get("content-type", "application/octet-stream"))
+        )
+
+    def compress(self, body: bytes, finish: bool) -> bytes:
+        if self.encoding == "br":
+            output = self.compressor.process(body)
+            return output + self.compressor.finish() if finish else output
+        output = self.compressor.compress(body)
+        return output + self.compressor.flush() if finish else output
+
+    async def start(self, body: bytes, more_body: bool):
+        headers = MutableHeaders(raw=self.start_message["headers"])
+        add_vary(headers, "Accept-Encoding")
+        if self.encoding is None or (not more_body and len(body) < self.minimum_size):
+            self.compressing = False
+            await self._send(self.start_message)
+            await self._send({"type": "http.response.body", "body": body, "more_body": more_body})
+            return
+
+        self.compressing = True
+        if self.encoding == "br":
+            self.compressor = brotli.Compressor(quality=self.level)
+        else:
+            self.compressor = zlib.compressobj(min(self.level, 9), zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        body = self.compress(body, not more_body)
+        headers["Content-Encoding"] = self.encoding
+        if more_body:
+            del headers["Content-Length"]
+        else:
+            headers["Content-Length"] = str(len(body))
+        await self._send(self.start_message)
+        await self._send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    async def send(self, message: Message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            if not self.is_compressible(Headers(raw=message["headers"])):
+                self.compressing = False
+                await self._send(message)
+            return
+
+        if self.compressing is False or message["type"] != "http.response.body":
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressing is None:
+            # Small bodies are buffered until it's known whether
+            # they're worth compressing.
+            self.buffer += body
+            if more_body and len(self.buffer) < self.minimum_size:
+                return
+            body, self.buffer = self.buffer, b""
+            await self.start(body, more_body)
+            return
+
+        await self._send({"type": "http.response.body", "body": self.compress(body, not more_body), "more_body": more_body})
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles sending `<file>.br` or `<file>.gz` next to the requested
+    file when the client accepts it, see scripts/precompress.py.
+    """
+    def file_response(self, full_path: str, stat_result: stat_result, scope: Scope, status_code: int = 200) -> Response:
+        encoding = get_accepted_encoding(Headers(scope=scope))
+        if encoding:
+            extension = ".br" if encoding == "br" else ".gz"
+            encoded_path, encoded_stat_result = self.lookup_path(self.get_path(scope) + extension)
+            # Stale when the original changed since it was compressed.
+            if encoded_stat_result is not None and encoded_stat_result.st_mtime >= stat_result.st_mtime:
+                response = super().file_response(encoded_path, encoded_stat_result, scope, status_code)
+                media_type = guess_type(full_path)[0] or "text/plain"
+                if media_type.startswith("text/"):
+                    media_type += "; charset=utf-8"
+                response.headers["Content-Type"] = media_type
+                response.headers["Content-Encoding"] = encoding
+                add_vary(response.headers, "Accept-Encoding")
+                return response
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        add_vary(response.headers, "Accept-Encoding")
+        return response
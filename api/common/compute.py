@@ -0,0 +1,54 @@
+from asyncio import get_running_loop
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from multiprocessing import get_context
+from typing import Any, Callable
+
+from starlette.concurrency import run_in_threadpool
+
+from .settings import api_settings
+
+_executor: ProcessPoolExecutor | None = None
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if not _executor:
+        # Spawned rather than forked, so children don't inherit
+        # the parent's MongoClient and threadpool state.
+        _executor = ProcessPoolExecutor(
+            max_workers=api_settings.compute_workers,
+            mp_context=get_context("spawn")
+        )
+    return _executor
+
+async def run_in_process(func: Callable, *args, **kwargs) -> Any:
+    """
+    Runs CPU-bound `func` in the compute process pool, so that it
+    doesn't hold the GIL of the worker serving other requests.
+    `func` and its arguments must be picklable.
+    """
+    if api_settings.compute_workers == 0:
+        return await run_in_threadpool(func, *args, **kwargs)
+    call = partial(func, *args, **kwargs)
+    executor = get_executor()
+    try:
+        return await get_running_loop().run_in_executor(executor, call)
+    except BrokenProcessPool:
+        # A child died abruptly, like killed for running out of memory,
+        # which breaks the pool for good. Retried once in a new one.
+        reset_executor(executor)
+        return await get_running_loop().run_in_executor(get_executor(), call)
+
+def reset_executor(executor: ProcessPoolExecutor):
+    global _executor
+    # Calls failing together replace the pool only once.
+    if _executor is executor:
+        _executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def shutdown_executor():
+    global _executor
+    if _executor:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
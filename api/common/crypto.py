@@ -0,0 +1,148 @@
+from base64 import b64decode
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Random import get_random_bytes
+from passlib.hash import argon2
+
+from ..models.images import LockVersion
+from .ingest import commit_file, discard_file, new_temporary_path
+from .paths import get_temporary_directory
+
+# Segmented files are split into independently authenticated segments of
+# SEGMENT_SIZE plaintext bytes, each followed by its tag. Segment nonces are
+# the file's nonce prefix, a big endian segment counter and a final segment
+# flag (STREAM construction), so segments can't be reordered or truncated.
+SEGMENT_SIZE = 65536 # 64KiB
+SEGMENT_TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+
+METADATA_KEY_CONTEXT = b"iamages metadata"
+FILE_KEY_CONTEXT = b"iamages file"
+
+def hash_password(key: str, salt: bytes = None) -> tuple[bytes, bytes]:
+    # Follow recommended rfc9106 parameters.
+    hasher = argon2.using(
+        salt=salt,
+        salt_len=16 if not salt else None,
+        hash_len=16,
+        time_cost=3,
+        memory_cost=65536,
+        parallelism=4
+    )
+    hashed_key = hasher.hash(key).split("$")
+    # Incorrect padding fix.
+    return (b64decode(hashed_key[-1] + "=="), b64decode(hashed_key[-2] + "=="))
+
+def derive_lock_keys(key: str, salt: bytes = None) -> tuple[bytes, bytes, bytes]:
+    """
+    Runs argon2 once and derives separate metadata and file keys from
+    its output with HKDF. Returns the metadata key, file key and salt.
+    """
+    master_key, salt = hash_password(key, salt)
+    metadata_key = HKDF(master_key, 16, None, SHA256, context=METADATA_KEY_CONTEXT)
+    file_key = HKDF(master_key, 16, None, SHA256, context=FILE_KEY_CONTEXT)
+    return metadata_key, file_key, salt
+
+def is_segmented(version: LockVersion) -> bool:
+    return version >= LockVersion.aes128gcm_stream_argon2
+
+def new_file_nonce() -> bytes:
+    return get_random_bytes(NONCE_PREFIX_SIZE)
+
+def get_segment_nonce(nonce_prefix: bytes, counter: int, is_last: bool) -> bytes:
+    return nonce_prefix + counter.to_bytes(4, "big") + (b"\x01" if is_last else b"\x00")
+
+def read_segments(file: BinaryIO, size: int) -> Iterator[tuple[bytes, bool]]:
+    # Reads one segment ahead to know which one is the last.
+    segment = file.read(size)
+    while True:
+        next_segment = file.read(size)
+        yield segment, not next_segment
+        if not next_segment:
+            return
+        segment = next_segment
+
+def decrypt_chunks(file: BinaryIO, key: bytes, nonce: bytes, tag: bytes | None, version: LockVersion) -> Iterator[bytes]:
+    if not is_segmented(version):
+        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+        yield cipher.decrypt_and_verify(file.read(), tag)
+        return
+    for counter, (segment, is_last) in enumerate(read_segments(file, SEGMENT_SIZE + SEGMENT_TAG_SIZE)):
+        cipher = AES.new(key, AES.MODE_GCM, nonce=get_segment_nonce(nonce, counter, is_last))
+        yield cipher.decrypt_and_verify(segment[:-SEGMENT_TAG_SIZE], segment[-SEGMENT_TAG_SIZE:])
+
+def encrypt_chunks(chunks: Iterator[bytes], file: BinaryIO, key: bytes, nonce: bytes):
+    # Re-chunks the plaintext to SEGMENT_SIZE, keeping one
+    # segment buffered to know which one is the last.
+    buffer = b""
+    counter = 0
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) > SEGMENT_SIZE:
+            cipher = AES.new(key, AES.MODE_GCM, nonce=get_segment_nonce(nonce, counter, False))
+            file.write(b"".join(cipher.encrypt_and_digest(buffer[:SEGMENT_SIZE])))
+            buffer = buffer[SEGMENT_SIZE:]
+            counter += 1
+    cipher = AES.new(key, AES.MODE_GCM, nonce=get_segment_nonce(nonce, counter, True))
+    file.write(b"".join(cipher.encrypt_and_digest(buffer)))
+
+def transform_file(source: Path, destination: Path, transform):
+    temporary_path = new_temporary_path(get_temporary_directory(destination))
+    try:
+        with open(source, "rb") as source_file, open(temporary_path, "wb") as temporary_file:
+            transform(source_file, temporary_file)
+        commit_file(temporary_path, destination)
+    except BaseException:
+        discard_file(temporary_path)
+        raise
+
+def encrypt_file(source: Path, destination: Path, key: bytes, nonce: bytes):
+    """
+    Encrypts `source` into `destination` as a segmented file,
+    in constant memory. `source` and `destination` may be the same.
+    """
+    transform_file(
+        source,
+        destination,
+        lambda source_file, destination_file: encrypt_chunks(
+            iter(lambda: source_file.read(SEGMENT_SIZE), b""),
+            destination_file,
+            key,
+            nonce
+        )
+    )
+
+def decrypt_file(source: Path, destination: Path, key: bytes, nonce: bytes, tag: bytes | None, version: LockVersion):
+    def decrypt(source_file: BinaryIO, destination_file: BinaryIO):
+        for chunk in decrypt_chunks(source_file, key, nonce, tag, version):
+            destination_file.write(chunk)
+    transform_file(source, destination, decrypt)
+
+def reencrypt_file(
+    source: Path,
+    destination: Path,
+    key: bytes,
+    nonce: bytes,
+    tag: bytes | None,
+    version: LockVersion,
+    new_key: bytes,
+    new_nonce: bytes
+):
+    """
+    Decrypts `source` and encrypts it again as a segmented file
+    using `new_key`. Older whole file locks are upgraded on the way.
+    """
+    transform_file(
+        source,
+        destination,
+        lambda source_file, destination_file: encrypt_chunks(
+            decrypt_chunks(source_file, key, nonce, tag, version),
+            destination_file,
+            new_key,
+            new_nonce
+        )
+    )
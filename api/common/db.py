@@ -9,3 +9,6 @@ db = MongoClient(
 db_images = db.images
 db_collections = db.collections
 db_users = db.users
+db_blobs = db.blobs
+db_upload_sessions = db.upload_sessions
+db_thumbnail_jobs = db.thumbnail_jobs
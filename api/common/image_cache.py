@@ -0,0 +1,78 @@
+from pathlib import Path
+from typing import Callable, Iterable
+
+from bson.objectid import ObjectId
+
+from ..models.images import ImageInDB
+from .cache import (ALL_KEYS, ChangeStreamInvalidationBus, InvalidationBus,
+                    LocalInvalidationBus, LRUCache)
+from .db import db_images
+from .settings import api_settings
+
+image_cache = LRUCache(api_settings.image_cache_size, api_settings.image_cache_ttl)
+_bus = InvalidationBus()
+# Other caches sharing the bus, by the prefix of their keys.
+_receivers: dict[str, Callable[[str], None]] = {}
+
+def find_image(id: ObjectId) -> ImageInDB | None:
+    """
+    Returns the image document with `id`, parsed, from this worker's cache
+    when possible. Cached images are shared, don't modify them.
+    """
+    image = image_cache.get(id)
+    if image is None:
+        generation = image_cache.generation
+        image_dict = db_images.find_one({"_id": id})
+        if not image_dict:
+            return None
+        image = ImageInDB.parse_obj(image_dict)
+        image_cache.set(id, image, generation)
+    return image
+
+def invalidate_images(ids: Iterable[ObjectId]):
+    for id in ids:
+        image_cache.pop(id)
+        _bus.publish(str(id))
+
+def invalidate_all_images():
+    image_cache.clear()
+    _bus.publish(ALL_KEYS)
+
+def add_invalidation_receiver(prefix: str, callback: Callable[[str], None]):
+    """
+    Passes invalidations of keys starting with `prefix`, published with
+    `publish_invalidation`, to `callback` without the prefix.
+    """
+    _receivers[prefix] = callback
+
+def publish_invalidation(key: str):
+    _bus.publish(key)
+
+def receive_invalidation(key: str):
+    if key == ALL_KEYS:
+        image_cache.clear()
+        for callback in _receivers.values():
+            callback(ALL_KEYS)
+        return
+    for prefix, callback in _receivers.items():
+        if key.startswith(prefix):
+            callback(key.removeprefix(prefix))
+            return
+    image_cache.pop(ObjectId(key))
+
+def start_invalidation_bus():
+    # Runs in every server worker after forking, each needs its own bus.
+    global _bus
+    if api_settings.image_cache_size <= 0 and api_settings.user_cache_size <= 0:
+        return
+    match api_settings.image_cache_invalidation:
+        case "local":
+            _bus = LocalInvalidationBus(Path(api_settings.storage_dir, ".invalidation"))
+        case "change_stream":
+            _bus = ChangeStreamInvalidationBus(db_images)
+        case _:
+            _bus = InvalidationBus()
+    _bus.subscribe(receive_invalidation)
+
+def stop_invalidation_bus():
+    _bus.close()
@@ -0,0 +1,274 @@
+from base64 import b64encode
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO
+
+from PIL import ExifTags
+from PIL import Image as PillowImage
+from PIL.Image import LANCZOS
+from PIL.ImageOps import exif_transpose
+
+from .ingest import (CHUNK_SIZE, commit_file, discard_file, hash_file,
+                     new_temporary_path)
+from .paths import get_temporary_directory
+from .settings import api_settings
+
+try:
+    # Registers AVIF support with Pillow, from the optional 'avif' extra.
+    import pillow_avif
+except ImportError:
+    pass
+
+PLACEHOLDER_SIZE = 16
+
+# Encoder options of thumbnails in other formats than their image's.
+THUMBNAIL_FORMAT_OPTIONS = {
+    "webp": {"quality": 80, "method": 4},
+    "avif": {"quality": 60, "speed": 6}
+}
+# Formats animated thumbnails can keep transparency in.
+ALPHA_FORMATS = {"GIF", "PNG", "WEBP", "AVIF"}
+
+# JPEG application segments kept when cutting out metadata: JFIF, ICC
+# profiles and Adobe colour transforms. Others, like EXIF (with GPS
+# positions), XMP and IPTC, and comments are dropped.
+JPEG_APP0, JPEG_APP2, JPEG_APP14, JPEG_APP15 = 0xE0, 0xE2, 0xEE, 0xEF
+JPEG_COM, JPEG_SOS, JPEG_EOI = 0xFE, 0xDA, 0xD9
+PNG_METADATA_CHUNKS = {b"eXIf", b"tEXt", b"zTXt", b"iTXt", b"tIME"}
+# Metadata Pillow reads from the headers of other formats.
+METADATA_INFO_KEYS = ("exif", "xmp", "XML:com.adobe.xmp", "comment")
+
+@dataclass
+class PreparedImage:
+    width: int
+    height: int
+    # passthrough, stripped (metadata cut out), reencoded or transposed.
+    action: str
+    # Hash of the rewritten file, unless it's passed through.
+    hash: str | None = None
+
+def get_orientation(pil_image: PillowImage.Image) -> int:
+    # Only look at the EXIF block parsed with the header, so that
+    # checking the orientation never decodes any pixel data.
+    exif = PillowImage.Exif()
+    if exif_bytes := pil_image.info.get("exif"):
+        exif.load(exif_bytes)
+    return exif.get(ExifTags.Base.Orientation, 1)
+
+def find_jpeg_metadata(file: BinaryIO) -> list[tuple[int, int]] | None:
+    # Segments before the image data, None when they can't be followed.
+    ranges = []
+    file.seek(2)
+    while True:
+        start = file.tell()
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code in (JPEG_SOS, JPEG_EOI):
+            return ranges
+        if 0xD0 <= code <= 0xD7 or code == 0x01:
+            continue
+        length = int.from_bytes(file.read(2), "big")
+        if length < 2:
+            return None
+        if code == JPEG_COM or (JPEG_APP0 <= code <= JPEG_APP15 and code not in (JPEG_APP0, JPEG_APP14)):
+            if code != JPEG_APP2 or file.read(12) != b"ICC_PROFILE\0":
+                ranges.append((start, start + 2 + length))
+        file.seek(start + 2 + length)
+
+def find_png_metadata(file: BinaryIO) -> list[tuple[int, int]] | None:
+    ranges = []
+    file.seek(8)
+    while True:
+        start = file.tell()
+        header = file.read(8)
+        if len(header) < 8:
+            return None
+        # Length, type, data and CRC.
+        end = start + 12 + int.from_bytes(header[:4], "big")
+        if header[4:] in PNG_METADATA_CHUNKS:
+            ranges.append((start, end))
+        if header[4:] == b"IEND":
+            return ranges
+        file.seek(end)
+
+def copy_without(source: Path, destination: Path, ranges: list[tuple[int, int]]):
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        for start, end in [*ranges, (None, None)]:
+            while start is None or source_file.tell() < start:
+                chunk = source_file.read(CHUNK_SIZE if start is None else min(CHUNK_SIZE, start - source_file.tell()))
+                if not chunk:
+                    break
+                destination_file.write(chunk)
+            if end is not None:
+                source_file.seek(end)
+
+def prepare_image(path: Path) -> PreparedImage:
+    """
+    Reads the image header at `path` and removes any metadata beyond what
+    displaying it needs, like EXIF with GPS positions, XMP or comments.
+    JPEG and PNG metadata is cut out without touching the image data,
+    other images are decoded and re-encoded in place when they carry any
+    or when their EXIF orientation requires transposing. Images without
+    metadata are left as they are.
+    """
+    with PillowImage.open(path) as original_pil_image:
+        width, height = original_pil_image.size
+        if get_orientation(original_pil_image) != 1:
+            # Correct orientation
+            pil_image = exif_transpose(original_pil_image)
+            width, height = pil_image.size
+            action = "transposed"
+        else:
+            ranges = None
+            if original_pil_image.format in ("JPEG", "PNG"):
+                with open(path, "rb") as file:
+                    if original_pil_image.format == "JPEG":
+                        ranges = find_jpeg_metadata(file)
+                    else:
+                        ranges = find_png_metadata(file)
+            if ranges == [] or (ranges is None and not any(original_pil_image.info.get(key) for key in METADATA_INFO_KEYS)):
+                return PreparedImage(width=width, height=height, action="passthrough")
+            if ranges:
+                stripped_path = new_temporary_path(path.parent)
+                try:
+                    copy_without(path, stripped_path, ranges)
+                    commit_file(stripped_path, path)
+                except BaseException:
+                    discard_file(stripped_path)
+                    raise
+                return PreparedImage(width=width, height=height, action="stripped", hash=hash_file(path))
+            pil_image = original_pil_image
+            action = "reencoded"
+
+        reencoded_path = new_temporary_path(path.parent)
+        try:
+            with open(reencoded_path, "wb") as reencoded_file:
+                pil_image.save(
+                    reencoded_file,
+                    format=original_pil_image.format,
+                    save_all=getattr(original_pil_image, "is_animated", False),
+                    # Metadata isn't carried over, only the colour profile.
+                    exif=b"",
+                    comment=b"",
+                    icc_profile=original_pil_image.info.get("icc_profile")
+                )
+            if pil_image is not original_pil_image:
+                pil_image.close()
+            commit_file(reencoded_path, path)
+        except BaseException:
+            discard_file(reencoded_path)
+            raise
+    return PreparedImage(width=width, height=height, action=action, hash=hash_file(path))
+
+def can_encode(format: str) -> bool:
+    PillowImage.init()
+    return format.upper() in PillowImage.SAVE
+
+def make_placeholder(source: Path) -> tuple[str, str] | None:
+    """
+    Tiny blurry WebP of the (first frame of the) image at `source`, as a
+    data URL, and its dominant colour as `#rrggbb`. None when it's over
+    IAMAGES_THUMBNAIL_MAX_PIXELS.
+    """
+    try:
+        pil_image = PillowImage.open(source)
+    except PillowImage.DecompressionBombError:
+        return None
+    with pil_image:
+        width, height = pil_image.size
+        if width * height > api_settings.thumbnail_max_pixels:
+            return None
+        pil_image.thumbnail((PLACEHOLDER_SIZE * 4, PLACEHOLDER_SIZE * 4), LANCZOS, reducing_gap=2.0)
+        small_pil_image = pil_image.convert("RGBA")
+
+    # Most common of a few colours, rather than the average which
+    # tends to grey.
+    quantized_pil_image = small_pil_image.convert("RGB").quantize(5)
+    _, index = max(quantized_pil_image.getcolors())
+    red, green, blue = quantized_pil_image.getpalette()[index * 3:index * 3 + 3]
+
+    small_pil_image.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), LANCZOS)
+    placeholder = BytesIO()
+    small_pil_image.save(placeholder, "WEBP", quality=50)
+    return f"data:image/webp;base64,{b64encode(placeholder.getvalue()).decode('ascii')}", f"#{red:02x}{green:02x}{blue:02x}"
+
+def sample_frames(frame_count: int, max_frames: int) -> list[int]:
+    # Evenly spread over the animation, always starting with the first.
+    if frame_count <= max_frames:
+        return list(range(frame_count))
+    return [index * frame_count // max_frames for index in range(max_frames)]
+
+def resize_frames(pil_image: PillowImage.Image, size: int, mode: str) -> tuple[list[PillowImage.Image], list[int]]:
+    """
+    Resizes at most IAMAGES_THUMBNAIL_MAX_FRAMES frames of an animated
+    `pil_image` into `mode`, each sampled frame lasting until the next one.
+    """
+    frame_indexes = set(sample_frames(pil_image.n_frames, api_settings.thumbnail_max_frames))
+    frames, durations = [], []
+    # Frames build on the ones before them, so all of them are decoded
+    # in order, but only sampled ones are resized and kept.
+    for index in range(pil_image.n_frames):
+        pil_image.seek(index)
+        if index in frame_indexes:
+            frame = pil_image.convert(mode)
+            frame.thumbnail((size, size), LANCZOS)
+            frames.append(frame)
+            durations.append(0)
+        durations[-1] += pil_image.info.get("duration", 0)
+    return frames, durations
+
+def make_thumbnail(source: Path, destination: Path, size: int, format: str | None = None) -> bool:
+    """
+    Writes a thumbnail of `source`, fitting in `size` x `size`, to
+    `destination`, in `format` or else the format of `source`. Returns
+    False without writing anything if it would be bigger than `source`,
+    or if decoding it would take more than IAMAGES_THUMBNAIL_MAX_PIXELS.
+    """
+    try:
+        pil_image = PillowImage.open(source)
+    except PillowImage.DecompressionBombError:
+        return False
+    with pil_image:
+        # Checked against the header, before decoding anything.
+        width, height = pil_image.size
+        # The other images of an MPO are views for stereo or multi
+        # picture displays, not frames, only the first is used.
+        frame_count = getattr(pil_image, "n_frames", 1) if pil_image.format != "MPO" else 1
+        if width * height * frame_count > api_settings.thumbnail_max_pixels:
+            return False
+
+        save_format = format.upper() if format else pil_image.format
+        save_options = THUMBNAIL_FORMAT_OPTIONS.get(format, {})
+        if frame_count > 1:
+            frames, durations = resize_frames(pil_image, size, "RGBA" if save_format in ALPHA_FORMATS else "RGB")
+            save_options = {
+                **save_options,
+                "save_all": len(frames) > 1,
+                "append_images": frames[1:],
+                "duration": durations,
+                "loop": pil_image.info.get("loop", 0)
+            }
+        else:
+            # JPEGs are scaled down by libjpeg while decoding (draft),
+            # other images reduced by whole factors, before the final
+            # resample from twice the size.
+            pil_image.thumbnail((size, size), LANCZOS, reducing_gap=2.0)
+            frames = [pil_image]
+
+        temporary_path = new_temporary_path(get_temporary_directory(destination))
+        try:
+            with open(temporary_path, "wb") as temporary_file:
+                frames[0].save(temporary_file, save_format, **save_options)
+
+            if source.stat().st_size < temporary_path.stat().st_size:
+                discard_file(temporary_path)
+                return False
+
+            commit_file(temporary_path, destination)
+        except BaseException:
+            discard_file(temporary_path)
+            raise
+    return True
@@ -0,0 +1,81 @@
+from dataclasses import dataclass
+from hashlib import blake2b
+from os import replace
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import BinaryIO
+
+import magic
+from fastapi import HTTPException, status
+
+CHUNK_SIZE = 1024 * 1024 # 1MB
+SNIFF_SIZE = 2048
+TEMPORARY_PREFIX = ".ingest-"
+
+@dataclass
+class IngestedFile:
+    path: Path
+    size: int
+    mime: str
+    hash: str
+
+def new_temporary_path(directory: Path) -> Path:
+    # Temporary files live in the same storage directory as their final
+    # destination so the commit is a same-filesystem atomic rename.
+    with NamedTemporaryFile(dir=directory, prefix=TEMPORARY_PREFIX, delete=False) as temporary:
+        return Path(temporary.name)
+
+def ingest_file(source: BinaryIO, directory: Path, max_size: int) -> IngestedFile:
+    """
+    Copies an upload into a temporary file inside `directory` in a single pass,
+    enforcing `max_size`, sniffing the MIME type and hashing the content on the way.
+    """
+    path = new_temporary_path(directory)
+    hash = blake2b(digest_size=32)
+    head = b""
+    size = 0
+    try:
+        with open(path, "wb") as temporary:
+            while chunk := source.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+                if len(head) < SNIFF_SIZE:
+                    head += chunk[:SNIFF_SIZE - len(head)]
+                hash.update(chunk)
+                temporary.write(chunk)
+    except BaseException:
+        path.unlink(True)
+        raise
+    return IngestedFile(
+        path=path,
+        size=size,
+        mime=magic.from_buffer(head, mime=True),
+        hash=hash.hexdigest()
+    )
+
+def hash_file(path: Path) -> str:
+    hash = blake2b(digest_size=32)
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+def commit_file(path: Path, destination: Path):
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    replace(path, destination)
+
+def discard_file(path: Path):
+    path.unlink(True)
+
+def inspect_file(path: Path) -> IngestedFile:
+    # For files which were already written into the storage directory,
+    # e.g. by resumable uploads.
+    with open(path, "rb") as file:
+        head = file.read(SNIFF_SIZE)
+    return IngestedFile(
+        path=path,
+        size=path.stat().st_size,
+        mime=magic.from_buffer(head, mime=True),
+        hash=hash_file(path)
+    )
@@ -1,3 +1,4 @@
+from hashlib import blake2b
 from pathlib import Path
 
 from .settings import api_settings
@@ -9,3 +10,68 @@ if not IMAGES_PATH.exists():
 THUMBNAILS_PATH = Path(api_settings.storage_dir, "thumbnails")
 if not THUMBNAILS_PATH.exists():
     THUMBNAILS_PATH.mkdir()
+
+UPLOADS_PATH = Path(api_settings.storage_dir, "uploads")
+if not UPLOADS_PATH.exists():
+    UPLOADS_PATH.mkdir()
+
+def get_image_file_name(id, type_extension: str, hash: str | None = None) -> str:
+    # Deduplicated files are stored under their content hash.
+    return f"{hash or id}{type_extension}"
+
+def get_thumbnail_file_name(file_name: str, size: int, format: str | None = None) -> str:
+    # The default size keeps the image's file name, other sizes get a
+    # suffix. Other formats than the image's replace its extension.
+    path = Path(file_name)
+    extension = f".{format}" if format else path.suffix
+    if size == api_settings.thumbnail_default_size:
+        return f"{path.stem}{extension}"
+    return f"{path.stem}@{size}{extension}"
+
+def get_thumbnail_file_names(file_name: str) -> list[str]:
+    sizes = {*api_settings.thumbnail_sizes, api_settings.thumbnail_default_size}
+    return [
+        get_thumbnail_file_name(file_name, size, format)
+        for size in sorted(sizes)
+        for format in [None, *api_settings.thumbnail_formats]
+    ]
+
+# Deepest fan-out layout looked through for files that haven't been moved yet.
+MAX_STORAGE_FANOUT = 3
+
+def get_file_path(directory: Path, file_name: str, fanout: int | None = None) -> Path:
+    """
+    Path of `file_name` in `directory` under the configured fan-out layout,
+    one level of two hex characters per `fanout` (`ab/cd/<file_name>`).
+    """
+    if fanout is None:
+        fanout = api_settings.storage_fanout
+    # Shards come from a hash of the name rather than its prefix, since
+    # ids start with their timestamp and would pile up in a few shards.
+    digest = blake2b(Path(file_name).stem.encode("utf-8"), digest_size=MAX_STORAGE_FANOUT).hexdigest()
+    return directory.joinpath(*[digest[level * 2:level * 2 + 2] for level in range(fanout)], file_name)
+
+def find_file(directory: Path, file_name: str) -> Path:
+    """
+    Path of the existing `file_name` in `directory`, also looking in other
+    layouts while `scripts/reshard.py` is moving files. Falls back to the
+    configured layout's path if it doesn't exist anywhere.
+    """
+    path = get_file_path(directory, file_name)
+    if path.exists():
+        return path
+    for fanout in range(MAX_STORAGE_FANOUT + 1):
+        if fanout == api_settings.storage_fanout:
+            continue
+        other_path = get_file_path(directory, file_name, fanout)
+        if other_path.exists():
+            return other_path
+    return path
+
+def get_temporary_directory(destination: Path) -> Path:
+    # Temporary files stay at the top of the storage directories, where
+    # collect_upload_sessions finds leftovers without walking every shard.
+    for directory in (IMAGES_PATH, THUMBNAILS_PATH):
+        if destination.is_relative_to(directory):
+            return directory
+    return destination.parent
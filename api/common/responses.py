@@ -0,0 +1,198 @@
+import os
+import re
+import stat
+from pathlib import Path
+from secrets import token_hex
+from urllib.parse import quote
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+
+from .settings import api_settings
+
+RANGE_REGEX = re.compile(r"^(\d*)-(\d*)$")
+# More ranges than this in one request are answered with the full file.
+MAX_RANGES = 16
+
+def parse_ranges(range_header: str, size: int) -> list[tuple[int, int]] | None:
+    """
+    Returns the inclusive (start, end) byte positions requested by a `bytes=`
+    range header, sorted and with overlapping or adjacent ranges merged.
+    Returns None for headers that should be ignored and an empty list
+    if none of the ranges can be satisfied.
+    """
+    unit, _, range_set = range_header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for range_spec in range_set.split(","):
+        match = RANGE_REGEX.match(range_spec.strip())
+        if not match or match.group(1) == match.group(2) == "":
+            return None
+        start, end = match.groups()
+        if start == "":
+            # Suffix range, the last `end` bytes.
+            if int(end) == 0:
+                continue
+            start = max(size - int(end), 0)
+            end = size - 1
+        else:
+            start = int(start)
+            if end and int(end) < start:
+                return None
+            end = min(int(end), size - 1) if end else size - 1
+        if start >= size:
+            continue
+        ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    merged_ranges = []
+    for start, end in sorted(ranges):
+        if merged_ranges and start <= merged_ranges[-1][1] + 1:
+            merged_ranges[-1] = (merged_ranges[-1][0], max(merged_ranges[-1][1], end))
+        else:
+            merged_ranges.append((start, end))
+    return merged_ranges
+
+class RangeFileResponse(FileResponse):
+    """
+    FileResponse answering `Range` requests with partial content, as a
+    single part or `multipart/byteranges`. Bodies go through the server's
+    zero-copy send extension (sendfile) when it offers one.
+    """
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.headers["accept-ranges"] = "bytes"
+        request_headers = Headers(scope=scope)
+        range_header = request_headers.get("range")
+        if not range_header or self.send_header_only or self.status_code != 200:
+            return await self.send_full(scope, receive, send)
+
+        if self.stat_result is None:
+            try:
+                self.stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+            except FileNotFoundError:
+                raise RuntimeError(f"File at path {self.path} does not exist.")
+            if not stat.S_ISREG(self.stat_result.st_mode):
+                raise RuntimeError(f"File at path {self.path} is not a file.")
+            self.set_stat_headers(self.stat_result)
+        size = self.stat_result.st_size
+
+        # A stale If-Range means the client's partial copy is outdated,
+        # so it gets the whole file instead.
+        if_range = request_headers.get("if-range")
+        if if_range and if_range.strip() not in (self.headers["etag"], self.headers["last-modified"]):
+            return await self.send_full(scope, receive, send)
+
+        ranges = parse_ranges(range_header, size)
+        if ranges is None:
+            return await self.send_full(scope, receive, send)
+
+        if not ranges:
+            self.status_code = 416
+            self.headers["content-range"] = f"bytes */{size}"
+            self.headers["content-length"] = "0"
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        self.status_code = 206
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+            self.headers["content-length"] = str(end - start + 1)
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await self.send_ranges(scope, send, [(b"", start, end)], b"")
+        else:
+            boundary = token_hex(16)
+            part_headers = [
+                "--{}\r\ncontent-type: {}\r\ncontent-range: bytes {}-{}/{}\r\n\r\n".format(
+                    boundary, self.media_type, start, end, size
+                ).encode("latin-1")
+                for start, end in ranges
+            ]
+            # Every part after the first starts on a new line.
+            parts = [
+                (part_header if i == 0 else b"\r\n" + part_header, start, end)
+                for i, (part_header, (start, end)) in enumerate(zip(part_headers, ranges))
+            ]
+            closing = f"\r\n--{boundary}--\r\n".encode("latin-1")
+            self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+            self.headers["content-length"] = str(
+                sum(len(part_header) + end - start + 1 for part_header, start, end in parts) + len(closing)
+            )
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await self.send_ranges(scope, send, parts, closing)
+        if self.background is not None:
+            await self.background()
+
+    async def send_full(self, scope: Scope, receive: Receive, send: Send):
+        if self.send_header_only or "http.response.zerocopysend" not in scope.get("extensions", {}):
+            return await super().__call__(scope, receive, send)
+        if self.stat_result is None:
+            try:
+                self.stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+            except FileNotFoundError:
+                raise RuntimeError(f"File at path {self.path} does not exist.")
+            self.set_stat_headers(self.stat_result)
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        await self.send_ranges(scope, send, [(b"", 0, self.stat_result.st_size - 1)], b"")
+        if self.background is not None:
+            await self.background()
+
+    async def send_ranges(self, scope: Scope, send: Send, parts: list[tuple[bytes, int, int]], closing: bytes):
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            for part_header, start, end in parts:
+                if part_header:
+                    await send({"type": "http.response.body", "body": part_header, "more_body": True})
+                if zerocopy:
+                    await send({
+                        "type": "http.response.zerocopysend",
+                        "file": file.wrapped.fileno(),
+                        "offset": start,
+                        "count": end - start + 1,
+                        "more_body": True
+                    })
+                    continue
+                await file.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": closing, "more_body": False})
+
+
+class OffloadedFileResponse(Response):
+    """
+    Empty response handing the file at `path` over to the front proxy
+    (nginx `X-Accel-Redirect` or Apache/lighttpd `X-Sendfile`), which
+    serves the bytes, ranges included, from the storage directory.
+    """
+    def __init__(
+        self,
+        path: Path,
+        headers: dict[str, str] | None = None,
+        media_type: str | None = None,
+        filename: str | None = None,
+        **kwargs
+    ):
+        super().__init__(headers=headers, media_type=media_type)
+        if filename is not None:
+            # Same as FileResponse, file names here are ids.
+            self.headers.setdefault("content-disposition", f'attachment; filename="{filename}"')
+        if api_settings.file_offload == "x_accel_redirect":
+            location = Path(path).relative_to(api_settings.storage_dir).as_posix()
+            self.headers["x-accel-redirect"] = quote(f"{api_settings.file_offload_prefix.rstrip('/')}/{location}")
+        else:
+            self.headers["x-sendfile"] = str(Path(path).resolve())
+
+def get_file_response_class(default: type[FileResponse]) -> type[FileResponse] | type[OffloadedFileResponse]:
+    if api_settings.file_offload == "none":
+        return default
+    return OffloadedFileResponse
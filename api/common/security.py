@@ -1,10 +1,16 @@
+from dataclasses import dataclass
+from time import time
+
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 
+from ..models.default import PyObjectId
 from ..models.users import User
-from .db import db_users
+from .cache import LRUCache
 from .settings import api_settings
+from .signing import verify_image_signature
+from .user_cache import find_user
 
 JWT_ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
@@ -12,20 +18,31 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/user/token")
 oauth2_optional_scheme = OAuth2PasswordBearer(tokenUrl="/user/token", auto_error=False)
 
-def common_get_user(token: str) -> User:
-    try:
-        payload = jwt.decode(token, api_settings.jwt_secret, algorithms=[JWT_ALGORITHM])
-        username = payload.get("sub")
-    except JWTError:
-        raise HTTPException(status.HTTP_401_UNAUTHORIZED)
-    if not username:
+# Username and expiry of verified tokens.
+token_cache = LRUCache(api_settings.user_cache_size, api_settings.user_cache_ttl)
+
+def get_token_username(token: str) -> str:
+    claims = token_cache.get(token)
+    if claims is None:
+        try:
+            payload = jwt.decode(token, api_settings.jwt_secret, algorithms=[JWT_ALGORITHM])
+        except JWTError:
+            raise HTTPException(status.HTTP_401_UNAUTHORIZED)
+        if not payload.get("sub"):
+            raise HTTPException(status.HTTP_401_UNAUTHORIZED)
+        claims = (payload["sub"], payload.get("exp"))
+        token_cache.set(token, claims)
+    username, expires = claims
+    # Checked by jwt.decode too, but tokens can expire while cached.
+    if expires is not None and expires <= time():
+        token_cache.pop(token)
         raise HTTPException(status.HTTP_401_UNAUTHORIZED)
-    user_dict = db_users.find_one({
-        "_id": username
-    })
-    if not user_dict:
+    return username
+
+def common_get_user(token: str) -> User:
+    user = find_user(get_token_username(token))
+    if not user:
         raise HTTPException(status.HTTP_401_UNAUTHORIZED)
-    user = User.parse_obj(user_dict)
     return user
 
 def get_user(token: str = Depends(oauth2_scheme)) -> User:
@@ -35,3 +52,27 @@ def get_optional_user(token: str | None = Depends(oauth2_optional_scheme)) -> Us
     if not token:
         return None
     return common_get_user(token)
+
+@dataclass
+class ImageAccess:
+    user: User | None
+    expires: int | None = None
+    signature: str | None = None
+
+    @property
+    def is_signed(self) -> bool:
+        return self.signature is not None
+
+def get_image_access(
+    id: PyObjectId,
+    expires: int | None = None,
+    signature: str | None = None,
+    token: str | None = Depends(oauth2_optional_scheme)
+) -> ImageAccess:
+    # A signed URL stands in for the user, without decoding the token
+    # or looking the user up.
+    if expires is not None or signature is not None:
+        if expires is None or signature is None or not verify_image_signature(id, expires, signature):
+            raise HTTPException(status.HTTP_401_UNAUTHORIZED, detail="The signature is invalid or has expired.")
+        return ImageAccess(None, expires, signature)
+    return ImageAccess(get_optional_user(token))
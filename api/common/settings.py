@@ -1,7 +1,54 @@
-from pydantic import BaseSettings, EmailStr, DirectoryPath
+from typing import Literal
+
+from pydantic import BaseSettings, DirectoryPath, EmailStr, conint
 
 class APISettings(BaseSettings):
     max_size: int = 30000000 # 30MB
+    max_batch_size: int = 50
+    compute_workers: int = 2
+    deduplicate_storage: bool = False
+    upload_session_ttl: int = 86400 # 1 day
+    image_processing_concurrency: int = 4
+    image_processing_queue_size: int = 16
+    password_hashing_concurrency: int = 2
+    password_hashing_queue_size: int = 8
+    admission_retry_after: int = 5
+    thumbnail_workers: int = 1
+    thumbnail_job_poll_interval: float = 1
+    thumbnail_job_lease: int = 300 # 5 minutes
+    thumbnail_job_max_attempts: int = 5
+    thumbnail_job_retry_delay: int = 30
+    thumbnail_wait: float = 5
+    thumbnail_sizes: list[int] = [128, 256, 512, 1024]
+    thumbnail_default_size: int = 512
+    thumbnail_formats: list[Literal["avif", "webp"]] = ["webp"]
+    thumbnail_max_pixels: int = 200000000
+    thumbnail_max_frames: int = 50
+    thumbnail_variant_concurrency: int = 2
+    thumbnail_variant_queue_size: int = 32
+    thumbnail_cache_budget: int = 1073741824 # 1GB
+    thumbnail_cache_eviction_interval: int = 300 # 5 minutes
+    image_cache_size: int = 4096
+    image_cache_ttl: int = 60
+    image_cache_invalidation: Literal["none", "local", "change_stream"] = "local"
+    user_cache_size: int = 4096
+    user_cache_ttl: int = 30
+    user_cache_negative_ttl: int = 5
+    file_offload: Literal["none", "x_accel_redirect", "x_sendfile"] = "none"
+    file_offload_prefix: str = "/internal"
+    signed_url_ttl: int = 3600 # 1 hour
+    storage_fanout: conint(ge=0, le=3) = 0
+    storage_backend: Literal["local", "s3"] = "local"
+    s3_endpoint_url: str | None
+    s3_region: str | None
+    s3_bucket: str | None
+    s3_prefix: str = ""
+    s3_access_key_id: str | None
+    s3_secret_access_key: str | None
+    s3_max_connections: int = 32
+    s3_multipart_chunk_size: int = 8388608 # 8MB
+    s3_presigned_redirects: bool = True
+    s3_presigned_url_ttl: int = 300 # 5 minutes
     db_url: str
     storage_dir: DirectoryPath
     jwt_secret: str
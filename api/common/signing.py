@@ -0,0 +1,24 @@
+import hmac
+from hashlib import sha256
+from time import time
+
+from bson.objectid import ObjectId
+
+from .settings import api_settings
+
+# Keeps signatures apart from anything else signed with the JWT secret.
+SIGNING_KEY = hmac.new(api_settings.jwt_secret.encode("utf-8"), b"iamages signed urls", sha256).digest()
+
+def get_signature_expiry() -> int:
+    # Expiry rounded up to a multiple of the TTL, so that a URL stays the
+    # same for a while and CDNs can cache it. It's valid for 1-2 TTLs.
+    ttl = api_settings.signed_url_ttl
+    return (int(time()) // ttl + 2) * ttl
+
+def sign_image(id: ObjectId, expires: int) -> str:
+    return hmac.new(SIGNING_KEY, f"{id}:{expires}".encode("utf-8"), sha256).hexdigest()
+
+def verify_image_signature(id: ObjectId, expires: int, signature: str) -> bool:
+    if expires < time():
+        return False
+    return hmac.compare_digest(sign_image(id, expires), signature)
@@ -0,0 +1,268 @@
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from pathlib import Path
+from threading import Lock
+from typing import AsyncIterator, Iterator
+
+from fastapi import Request, status
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from .ingest import CHUNK_SIZE, commit_file, discard_file, new_temporary_path
+from .paths import MAX_STORAGE_FANOUT, find_file, get_file_path
+from .responses import (RangeFileResponse, get_file_response_class,
+                        parse_ranges)
+from .settings import api_settings
+
+
+class Storage(ABC):
+    """
+    Where image and thumbnail files are kept. Files are addressed by their
+    storage directory (IMAGES_PATH or THUMBNAILS_PATH) and file name.
+
+    Processing always works on local files: `put` takes over a local file,
+    `open_local` provides one to read from.
+    """
+    @abstractmethod
+    def exists(self, directory: Path, file_name: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def put(self, path: Path, directory: Path, file_name: str):
+        raise NotImplementedError
+
+    def get(self, directory: Path, file_name: str) -> Iterator[bytes]:
+        return self.get_range(directory, file_name, 0, None)
+
+    @abstractmethod
+    def get_range(self, directory: Path, file_name: str, start: int, end: int | None) -> Iterator[bytes]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, directory: Path, file_name: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    @asynccontextmanager
+    async def open_local(self, directory: Path, file_name: str) -> AsyncIterator[Path]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_response(
+        self,
+        directory: Path,
+        file_name: str,
+        request: Request,
+        headers: dict[str, str],
+        media_type: str,
+        filename: str,
+        allow_redirect: bool = True
+    ) -> Response:
+        raise NotImplementedError
+
+
+class LocalStorage(Storage):
+    """
+    Files in the storage directory, under the IAMAGES_STORAGE_FANOUT layout.
+    """
+    def exists(self, directory: Path, file_name: str) -> bool:
+        return find_file(directory, file_name).exists()
+
+    def put(self, path: Path, directory: Path, file_name: str):
+        destination = get_file_path(directory, file_name)
+        commit_file(path, destination)
+        # Older copies in layouts not moved by scripts/reshard.py yet.
+        for fanout in range(MAX_STORAGE_FANOUT + 1):
+            if fanout != api_settings.storage_fanout:
+                get_file_path(directory, file_name, fanout).unlink(True)
+
+    def get_range(self, directory: Path, file_name: str, start: int, end: int | None) -> Iterator[bytes]:
+        with open(find_file(directory, file_name), "rb") as file:
+            file.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                chunk = file.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, directory: Path, file_name: str):
+        find_file(directory, file_name).unlink(True)
+
+    @asynccontextmanager
+    async def open_local(self, directory: Path, file_name: str) -> AsyncIterator[Path]:
+        yield find_file(directory, file_name)
+
+    def get_response(
+        self,
+        directory: Path,
+        file_name: str,
+        request: Request,
+        headers: dict[str, str],
+        media_type: str,
+        filename: str,
+        allow_redirect: bool = True
+    ) -> Response:
+        return get_file_response_class(RangeFileResponse)(
+            find_file(directory, file_name),
+            media_type=media_type,
+            headers=headers,
+            filename=filename,
+            method=request.method
+        )
+
+
+class S3Storage(Storage):
+    """
+    Files in an S3 compatible bucket, as `<prefix><directory name>/<file name>`.
+    Reads are redirected to presigned URLs when allowed, otherwise
+    streamed through the server.
+    """
+    def __init__(self):
+        self._client = None
+        self._client_lock = Lock()
+
+    @property
+    def client(self):
+        # Created on first use, in the server worker rather than the
+        # preloading master, since connection pools don't survive forks.
+        with self._client_lock:
+            if self._client is None:
+                try:
+                    import boto3
+                    from boto3.s3.transfer import TransferConfig
+                    from botocore.config import Config
+                except ImportError:
+                    raise RuntimeError("The s3 storage backend requires boto3, install the 's3' extra.")
+                self._client = boto3.client(
+                    "s3",
+                    endpoint_url=api_settings.s3_endpoint_url,
+                    region_name=api_settings.s3_region,
+                    aws_access_key_id=api_settings.s3_access_key_id,
+                    aws_secret_access_key=api_settings.s3_secret_access_key,
+                    config=Config(
+                        max_pool_connections=api_settings.s3_max_connections,
+                        retries={"mode": "standard"}
+                    )
+                )
+                self._transfer_config = TransferConfig(
+                    multipart_threshold=api_settings.s3_multipart_chunk_size,
+                    multipart_chunksize=api_settings.s3_multipart_chunk_size,
+                    max_concurrency=4
+                )
+            return self._client
+
+    def get_key(self, directory: Path, file_name: str) -> str:
+        return f"{api_settings.s3_prefix}{directory.name}/{file_name}"
+
+    def exists(self, directory: Path, file_name: str) -> bool:
+        try:
+            self.client.head_object(Bucket=api_settings.s3_bucket, Key=self.get_key(directory, file_name))
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+        return True
+
+    def put(self, path: Path, directory: Path, file_name: str):
+        # Multipart upload streamed from the file, in
+        # IAMAGES_S3_MULTIPART_CHUNK_SIZE parts.
+        client = self.client
+        try:
+            with open(path, "rb") as file:
+                client.upload_fileobj(
+                    file,
+                    api_settings.s3_bucket,
+                    self.get_key(directory, file_name),
+                    Config=self._transfer_config
+                )
+        finally:
+            discard_file(path)
+
+    def get_range(self, directory: Path, file_name: str, start: int, end: int | None) -> Iterator[bytes]:
+        response = self.client.get_object(
+            Bucket=api_settings.s3_bucket,
+            Key=self.get_key(directory, file_name),
+            Range=f"bytes={start}-{'' if end is None else end}"
+        )
+        yield from response["Body"].iter_chunks(CHUNK_SIZE)
+
+    def delete(self, directory: Path, file_name: str):
+        self.client.delete_object(Bucket=api_settings.s3_bucket, Key=self.get_key(directory, file_name))
+
+    @asynccontextmanager
+    async def open_local(self, directory: Path, file_name: str) -> AsyncIterator[Path]:
+        # Downloaded next to the local scratch files of `directory`.
+        path = new_temporary_path(directory)
+        try:
+            await run_in_threadpool(self.download, directory, file_name, path)
+            yield path
+        finally:
+            discard_file(path)
+
+    def download(self, directory: Path, file_name: str, path: Path):
+        client = self.client
+        with open(path, "wb") as file:
+            client.download_fileobj(
+                api_settings.s3_bucket,
+                self.get_key(directory, file_name),
+                file,
+                Config=self._transfer_config
+            )
+
+    def get_response(
+        self,
+        directory: Path,
+        file_name: str,
+        request: Request,
+        headers: dict[str, str],
+        media_type: str,
+        filename: str,
+        allow_redirect: bool = True
+    ) -> Response:
+        key = self.get_key(directory, file_name)
+        if allow_redirect and api_settings.s3_presigned_redirects:
+            return RedirectResponse(
+                self.client.generate_presigned_url("get_object", Params={
+                    "Bucket": api_settings.s3_bucket,
+                    "Key": key,
+                    "ResponseContentType": media_type,
+                    "ResponseContentDisposition": f'attachment; filename="{filename}"'
+                }, ExpiresIn=api_settings.s3_presigned_url_ttl),
+                status.HTTP_307_TEMPORARY_REDIRECT
+            )
+
+        size = self.client.head_object(Bucket=api_settings.s3_bucket, Key=key)["ContentLength"]
+        headers = {
+            **headers,
+            "Accept-Ranges": "bytes",
+            "Content-Disposition": f'attachment; filename="{filename}"'
+        }
+        # Single ranges are passed on to the bucket, anything else gets the whole file.
+        ranges = None
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header and (not if_range or if_range.strip() in (headers.get("ETag"), headers.get("Last-Modified"))):
+            ranges = parse_ranges(range_header, size)
+        if ranges == []:
+            return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers={
+                "Content-Range": f"bytes */{size}"
+            })
+        start, end, status_code = 0, size - 1, status.HTTP_200_OK
+        if ranges and len(ranges) == 1:
+            (start, end), status_code = ranges[0], status.HTTP_206_PARTIAL_CONTENT
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        if request.method == "HEAD":
+            return Response(status_code=status_code, headers=headers, media_type=media_type)
+        return StreamingResponse(
+            self.get_range(directory, file_name, start, end),
+            status_code=status_code,
+            headers=headers,
+            media_type=media_type
+        )
+
+
+storage = S3Storage() if api_settings.storage_backend == "s3" else LocalStorage()
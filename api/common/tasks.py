@@ -0,0 +1,38 @@
+from asyncio import CancelledError, Task, create_task, sleep
+from inspect import iscoroutinefunction
+from traceback import print_exception
+from typing import Callable, Coroutine
+
+from starlette.concurrency import run_in_threadpool
+
+_tasks: set[Task] = set()
+
+def run_in_background(coroutine: Coroutine) -> Task:
+    # Kept until done, and cancelled when the server worker stops.
+    task = create_task(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+def run_periodically(func: Callable, interval: float):
+    """
+    Runs `func` every `interval` seconds for as long as the server
+    worker is up, in the threadpool unless it's a coroutine function.
+    """
+    async def loop():
+        while True:
+            try:
+                if iscoroutinefunction(func):
+                    await func()
+                else:
+                    await run_in_threadpool(func)
+            except CancelledError:
+                raise
+            except Exception as e:
+                print_exception(e)
+            await sleep(interval)
+    run_in_background(loop())
+
+def cancel_tasks():
+    for task in _tasks:
+        task.cancel()
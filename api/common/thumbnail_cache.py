@@ -0,0 +1,123 @@
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from time import time
+
+from .paths import THUMBNAILS_PATH, get_thumbnail_file_names
+from .settings import api_settings
+from .storage import storage
+
+
+class ThumbnailIndex:
+    """
+    Sizes and last accesses of the thumbnail variants created on demand,
+    in a SQLite database shared by the server workers of a machine.
+    Accesses are kept in memory until `flush`, so serving a variant
+    doesn't write to the database.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.evictions = 0
+        self._connection: sqlite3.Connection | None = None
+        self._accesses: dict[str, float] = {}
+        self._lock = Lock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # Opened on first use, in the server worker rather than the
+        # preloading master, since connections don't survive forks.
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS variants (
+                    file_name TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    accessed_on REAL NOT NULL
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS variants_accessed_on ON variants (accessed_on)")
+            self._connection = connection
+        return self._connection
+
+    def add(self, file_name: str, size: int):
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO variants (file_name, size, accessed_on) VALUES (?, ?, ?)",
+                (file_name, size, time())
+            )
+
+    def touch(self, file_name: str):
+        with self._lock:
+            self._accesses[file_name] = time()
+
+    def remove(self, file_names: list[str]):
+        with self._lock:
+            for file_name in file_names:
+                self._accesses.pop(file_name, None)
+            self.connection.executemany("DELETE FROM variants WHERE file_name = ?", [(file_name,) for file_name in file_names])
+
+    def flush(self):
+        with self._lock:
+            accesses, self._accesses = self._accesses, {}
+            self.connection.executemany(
+                "UPDATE variants SET accessed_on = MAX(accessed_on, ?) WHERE file_name = ?",
+                [(accessed_on, file_name) for file_name, accessed_on in accesses.items()]
+            )
+
+    def get_total_size(self) -> int:
+        with self._lock:
+            return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM variants").fetchone()[0]
+
+    def pop_least_recently_used(self, size: int) -> list[str]:
+        """
+        Removes the least recently used variants adding up to at least
+        `size` bytes from the index and returns their file names.
+        """
+        with self._lock:
+            connection = self.connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                file_names = []
+                freed = 0
+                for file_name, variant_size in connection.execute("SELECT file_name, size FROM variants ORDER BY accessed_on"):
+                    if freed >= size:
+                        break
+                    file_names.append(file_name)
+                    freed += variant_size
+                connection.executemany("DELETE FROM variants WHERE file_name = ?", [(file_name,) for file_name in file_names])
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            self.evictions += len(file_names)
+            return file_names
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            count, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM variants").fetchone()
+        return {
+            "variants": count,
+            "size": size,
+            "budget": api_settings.thumbnail_cache_budget,
+            "evictions": self.evictions
+        }
+
+thumbnail_index = ThumbnailIndex(Path(api_settings.storage_dir, ".thumbnail-index.sqlite3"))
+
+def evict_thumbnail_variants():
+    thumbnail_index.flush()
+    excess = thumbnail_index.get_total_size() - api_settings.thumbnail_cache_budget
+    if excess <= 0:
+        return
+    # Down to 90% of the budget, so that not every new variant
+    # has to wait for the next eviction.
+    for file_name in thumbnail_index.pop_least_recently_used(excess + api_settings.thumbnail_cache_budget // 10):
+        storage.delete(THUMBNAILS_PATH, file_name)
+
+def delete_thumbnails(file_name: str):
+    # Every size of the thumbnail of the image stored as `file_name`.
+    file_names = get_thumbnail_file_names(file_name)
+    for thumbnail_file_name in file_names:
+        storage.delete(THUMBNAILS_PATH, thumbnail_file_name)
+    thumbnail_index.remove(file_names)
@@ -0,0 +1,392 @@
+from asyncio import Future, get_running_loop, shield, sleep, wait_for
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import monotonic
+from traceback import format_exception_only, print_exception
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from starlette.concurrency import run_in_threadpool
+
+from ..models.images import ImageInDB
+from ..models.thumbnails import ThumbnailJob, ThumbnailJobState
+from .cache import LRUCache
+from .compute import run_in_process
+from .db import db_images, db_thumbnail_jobs
+from .image_cache import invalidate_images
+from .imaging import can_encode, make_placeholder, make_thumbnail
+from .ingest import discard_file, new_temporary_path
+from .paths import (IMAGES_PATH, THUMBNAILS_PATH, get_image_file_name,
+                    get_thumbnail_file_name)
+from .settings import api_settings
+from .storage import storage
+from .tasks import run_in_background
+from .thumbnail_cache import thumbnail_index
+
+for thumbnail_format in api_settings.thumbnail_formats:
+    if not can_encode(thumbnail_format):
+        raise RuntimeError(f"Pillow can't encode {thumbnail_format} thumbnails, install the 'avif' extra or remove it from IAMAGES_THUMBNAIL_FORMATS.")
+
+# Thumbnail jobs running in this process, by image id.
+_builds: dict[ObjectId, Future] = {}
+# Thumbnail variants being created in this process, by file name.
+_variant_builds: dict[str, Future] = {}
+# Variants that turned out bigger than their source, not tried again for a while.
+_unavailable_variants = LRUCache(4096, 3600)
+
+def set_unavailable(id: ObjectId):
+    db_images.update_one({
+        "_id": id
+    }, {
+        "$set": {
+            "thumbnail": {
+                "is_computing": False,
+                "is_unavailable": True
+            }
+        }
+    })
+    invalidate_images([id])
+
+def set_placeholder(id: ObjectId, placeholder: tuple[str, str] | None):
+    if not placeholder:
+        return
+    # Unless it got locked meanwhile.
+    db_images.update_one({
+        "_id": id,
+        "thumbnail": {"$ne": None}
+    }, {
+        "$set": {
+            "thumbnail.placeholder": placeholder[0],
+            "thumbnail.color": placeholder[1]
+        }
+    })
+    invalidate_images([id])
+
+async def get_placeholder(path: Path) -> tuple[str, str] | None:
+    # Nice to have, never worth failing the thumbnail over.
+    try:
+        return await run_in_process(make_placeholder, path)
+    except Exception as e:
+        print_exception(e)
+        return None
+
+def claim_thumbnail_build(id: ObjectId) -> bool:
+    """
+    Marks the thumbnail of `id` as computing, unless another builder
+    holds an unexpired lease on it. Returns whether it was claimed.
+    """
+    now = datetime.now(timezone.utc)
+    image_dict = db_images.find_one_and_update({
+        "_id": id,
+        "$or": [
+            {"thumbnail.is_computing": False},
+            {"thumbnail.lease_expires_on": {"$exists": False}},
+            {"thumbnail.lease_expires_on": {"$lt": now}}
+        ]
+    }, {
+        "$set": {
+            "thumbnail.is_computing": True,
+            "thumbnail.lease_expires_on": now + timedelta(seconds=api_settings.thumbnail_job_lease)
+        }
+    }, projection={"_id": 1})
+    if not image_dict:
+        return False
+    invalidate_images([id])
+    return True
+
+def release_thumbnail_build(id: ObjectId):
+    db_images.update_one({"_id": id}, {
+        "$set": {
+            "thumbnail.is_computing": False
+        },
+        "$unset": {
+            "thumbnail.lease_expires_on": None
+        }
+    })
+    invalidate_images([id])
+
+async def create_thumbnail(image: ImageInDB) -> bool | None:
+    """
+    Creates the thumbnail of `image`, returns False when it was marked
+    unavailable instead and None when someone else is creating it.
+    """
+    file_name = get_image_file_name(image.id, image.file.type_extension, image.file.hash)
+    # Deduplicated images share their thumbnail.
+    if await run_in_threadpool(storage.exists, THUMBNAILS_PATH, file_name):
+        if not image.thumbnail.placeholder:
+            async with storage.open_local(THUMBNAILS_PATH, file_name) as thumbnail_path:
+                placeholder = await get_placeholder(thumbnail_path)
+            await run_in_threadpool(set_placeholder, image.id, placeholder)
+        return True
+
+    if not await run_in_threadpool(claim_thumbnail_build, image.id):
+        return None
+    try:
+        thumbnail_path = new_temporary_path(THUMBNAILS_PATH)
+        try:
+            async with storage.open_local(IMAGES_PATH, file_name) as file_path:
+                if not await run_in_process(make_thumbnail, file_path, thumbnail_path, api_settings.thumbnail_default_size):
+                    placeholder = await get_placeholder(file_path)
+                    await run_in_threadpool(set_unavailable, image.id)
+                    await run_in_threadpool(set_placeholder, image.id, placeholder)
+                    return False
+            # From the thumbnail, much cheaper to decode than the image.
+            placeholder = await get_placeholder(thumbnail_path)
+            await run_in_threadpool(storage.put, thumbnail_path, THUMBNAILS_PATH, file_name)
+        finally:
+            discard_file(thumbnail_path)
+    except BaseException:
+        await run_in_threadpool(release_thumbnail_build, image.id)
+        raise
+
+    await run_in_threadpool(set_placeholder, image.id, placeholder)
+    await run_in_threadpool(release_thumbnail_build, image.id)
+    return True
+
+async def create_thumbnail_variant(image: ImageInDB, size: int, format: str | None = None) -> bool:
+    """
+    Creates the thumbnail of `image` in a size other than the default
+    or another format than the image's, on demand. Returns False when
+    it would be bigger than its source.
+    """
+    file_name = get_image_file_name(image.id, image.file.type_extension, image.file.hash)
+    variant_file_name = get_thumbnail_file_name(file_name, size, format)
+    if build := _variant_builds.get(variant_file_name):
+        return await shield(build)
+    if _unavailable_variants.get(variant_file_name):
+        return False
+
+    build = get_running_loop().create_future()
+    _variant_builds[variant_file_name] = build
+    created = False
+    try:
+        # Smaller sizes and other formats of the default size are made from
+        # the default thumbnail, which is much cheaper to decode than the
+        # original. There's none when it was bigger than the original.
+        source_directory = IMAGES_PATH
+        if size <= api_settings.thumbnail_default_size and await run_in_threadpool(storage.exists, THUMBNAILS_PATH, file_name):
+            source_directory = THUMBNAILS_PATH
+        variant_path = new_temporary_path(THUMBNAILS_PATH)
+        try:
+            async with storage.open_local(source_directory, file_name) as source_path:
+                created = await run_in_process(make_thumbnail, source_path, variant_path, size, format)
+            if created:
+                variant_size = variant_path.stat().st_size
+                await run_in_threadpool(storage.put, variant_path, THUMBNAILS_PATH, variant_file_name)
+                await run_in_threadpool(thumbnail_index.add, variant_file_name, variant_size)
+            else:
+                _unavailable_variants.set(variant_file_name, True)
+        finally:
+            discard_file(variant_path)
+    finally:
+        del _variant_builds[variant_file_name]
+        build.set_result(created)
+    return created
+
+def enqueue_thumbnails(ids: list[ObjectId]):
+    """
+    Queues thumbnail jobs for new (or newly unlocked) images, starting
+    over any job already queued for them.
+    """
+    if not ids:
+        return
+    now = datetime.now(timezone.utc)
+    db_thumbnail_jobs.bulk_write([
+        UpdateOne({
+            "_id": id
+        }, {
+            "$set": {
+                "state": ThumbnailJobState.pending,
+                "attempts": 0,
+                "available_on": now
+            },
+            "$unset": {
+                "lease_expires_on": None,
+                "error": None
+            },
+            "$setOnInsert": {
+                "created_on": now
+            }
+        }, upsert=True)
+        for id in ids
+    ], ordered=False)
+
+def ensure_thumbnail_job(id: ObjectId):
+    # For images which missed being queued, leaves existing jobs alone.
+    now = datetime.now(timezone.utc)
+    db_thumbnail_jobs.update_one({
+        "_id": id
+    }, {
+        "$setOnInsert": {
+            "state": ThumbnailJobState.pending,
+            "attempts": 0,
+            "available_on": now,
+            "created_on": now
+        }
+    }, upsert=True)
+
+def claim_thumbnail_job(id: ObjectId | None = None) -> ThumbnailJob | None:
+    # Jobs of workers that died while running them are taken over
+    # once their lease expires.
+    now = datetime.now(timezone.utc)
+    query = {
+        "$or": [
+            {"state": ThumbnailJobState.pending, "available_on": {"$lte": now}},
+            {"state": ThumbnailJobState.running, "lease_expires_on": {"$lt": now}}
+        ]
+    }
+    if id:
+        query["_id"] = id
+    job_dict = db_thumbnail_jobs.find_one_and_update(query, {
+        "$set": {
+            "state": ThumbnailJobState.running,
+            "lease_expires_on": now + timedelta(seconds=api_settings.thumbnail_job_lease)
+        },
+        "$inc": {
+            "attempts": 1
+        }
+    }, sort=[("available_on", ASCENDING)], return_document=ReturnDocument.AFTER)
+    if not job_dict:
+        return None
+    return ThumbnailJob.parse_obj(job_dict)
+
+def complete_thumbnail_job(job: ThumbnailJob):
+    # Unless the job was queued again meanwhile.
+    db_thumbnail_jobs.delete_one({
+        "_id": job.id,
+        "state": ThumbnailJobState.running,
+        "attempts": job.attempts
+    })
+
+def postpone_thumbnail_job(job: ThumbnailJob):
+    # Not a failure, the image is being built by another job run.
+    db_thumbnail_jobs.update_one({
+        "_id": job.id,
+        "state": ThumbnailJobState.running,
+        "attempts": job.attempts
+    }, {
+        "$set": {
+            "state": ThumbnailJobState.pending,
+            "available_on": datetime.now(timezone.utc) + timedelta(seconds=api_settings.thumbnail_job_retry_delay)
+        },
+        "$inc": {
+            "attempts": -1
+        },
+        "$unset": {
+            "lease_expires_on": None
+        }
+    })
+
+def fail_thumbnail_job(job: ThumbnailJob, error: str):
+    if job.attempts >= api_settings.thumbnail_job_max_attempts:
+        update = {
+            "state": ThumbnailJobState.dead,
+            "error": error
+        }
+        set_unavailable(job.id)
+    else:
+        update = {
+            "state": ThumbnailJobState.pending,
+            "available_on": datetime.now(timezone.utc) + timedelta(
+                seconds=api_settings.thumbnail_job_retry_delay * 2 ** (job.attempts - 1)
+            ),
+            "error": error
+        }
+    db_thumbnail_jobs.update_one({
+        "_id": job.id,
+        "state": ThumbnailJobState.running,
+        "attempts": job.attempts
+    }, {
+        "$set": update,
+        "$unset": {
+            "lease_expires_on": None
+        }
+    })
+
+async def run_thumbnail_job(job: ThumbnailJob):
+    image_dict = await run_in_threadpool(db_images.find_one, {"_id": job.id})
+    image = ImageInDB.parse_obj(image_dict) if image_dict else None
+    # Deleted or locked since.
+    if not image or image.lock.is_locked or not image.thumbnail:
+        await run_in_threadpool(complete_thumbnail_job, job)
+        return
+    if job.attempts > api_settings.thumbnail_job_max_attempts:
+        # Crashed the workers running it every time.
+        await run_in_threadpool(fail_thumbnail_job, job, "Lease expired too many times.")
+        return
+    try:
+        created = await create_thumbnail(image)
+    except Exception as e:
+        print_exception(e)
+        await run_in_threadpool(fail_thumbnail_job, job, "".join(format_exception_only(e)).strip())
+        return
+    if created is None:
+        await run_in_threadpool(postpone_thumbnail_job, job)
+        return
+    await run_in_threadpool(complete_thumbnail_job, job)
+
+def start_thumbnail_job(job: ThumbnailJob, build: Future | None = None) -> Future:
+    """
+    Runs `job` in the background. Requests for its thumbnail in this
+    process wait for the returned future, or `build` if it was reserved
+    already, instead of polling.
+    """
+    if not build:
+        build = get_running_loop().create_future()
+    _builds[job.id] = build
+    async def run():
+        try:
+            await run_thumbnail_job(job)
+        finally:
+            _builds.pop(job.id, None)
+            build.set_result(None)
+    run_in_background(run())
+    return build
+
+async def run_thumbnail_jobs():
+    # Until the queue is empty.
+    while job := await run_in_threadpool(claim_thumbnail_job):
+        await shield(start_thumbnail_job(job))
+
+async def wait_for_thumbnail(id: ObjectId) -> bool:
+    """
+    Waits up to IAMAGES_THUMBNAIL_WAIT seconds for the thumbnail job of
+    `id` to finish, running it right away if it's still queued and
+    this process has a free thumbnail worker.
+    Returns False when it's still running after that.
+    """
+    deadline = monotonic() + api_settings.thumbnail_wait
+    if id not in _builds and len(_builds) < api_settings.thumbnail_workers:
+        # The worker is reserved before the claim is awaited, or
+        # concurrent requests would all find it free.
+        build = get_running_loop().create_future()
+        _builds[id] = build
+        job = None
+        try:
+            job = await run_in_threadpool(claim_thumbnail_job, id)
+        finally:
+            if not job:
+                _builds.pop(id, None)
+                build.set_result(None)
+        if job:
+            start_thumbnail_job(job, build)
+    while (remaining := deadline - monotonic()) > 0:
+        if build := _builds.get(id):
+            try:
+                await wait_for(shield(build), remaining)
+            except TimeoutError:
+                return False
+            # Or released without a job, which may be running elsewhere.
+            continue
+        # Running in another process.
+        job_dict = await run_in_threadpool(db_thumbnail_jobs.find_one, {"_id": id}, {"state": 1})
+        if not job_dict or job_dict["state"] != ThumbnailJobState.running:
+            return True
+        await sleep(min(0.25, remaining))
+    return False
+
+def get_thumbnail_job_stats() -> dict[str, int]:
+    return {
+        state.value: db_thumbnail_jobs.count_documents({"state": state})
+        for state in ThumbnailJobState
+    }
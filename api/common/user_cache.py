@@ -0,0 +1,47 @@
+from ..models.users import User
+from .cache import ALL_KEYS, LRUCache
+from .db import db_users
+from .image_cache import add_invalidation_receiver, publish_invalidation
+from .settings import api_settings
+
+# Published on the image cache's invalidation bus.
+USER_KEY_PREFIX = "user:"
+
+user_cache = LRUCache(api_settings.user_cache_size, api_settings.user_cache_ttl)
+# Usernames of tokens whose user doesn't exist (anymore).
+unknown_user_cache = LRUCache(api_settings.user_cache_size, api_settings.user_cache_negative_ttl)
+
+def find_user(username: str) -> User | None:
+    """
+    Returns the user named `username`, parsed, from this worker's cache
+    when possible. Cached users are shared, don't modify them.
+    """
+    user = user_cache.get(username)
+    if user is not None:
+        return user
+    if unknown_user_cache.get(username):
+        return None
+    # Each cache is invalidated on its own.
+    generation = user_cache.generation
+    unknown_generation = unknown_user_cache.generation
+    user_dict = db_users.find_one({"_id": username})
+    if not user_dict:
+        unknown_user_cache.set(username, True, unknown_generation)
+        return None
+    user = User.parse_obj(user_dict)
+    user_cache.set(username, user, generation)
+    return user
+
+def invalidate_user(username: str):
+    receive_invalidation(username)
+    publish_invalidation(f"{USER_KEY_PREFIX}{username}")
+
+def receive_invalidation(username: str):
+    if username == ALL_KEYS:
+        user_cache.clear()
+        unknown_user_cache.clear()
+    else:
+        user_cache.pop(username)
+        unknown_user_cache.pop(username)
+
+add_invalidation_receiver(USER_KEY_PREFIX, receive_invalidation)
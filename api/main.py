@@ -1,12 +1,19 @@
 from pathlib import Path
 
-from brotli_asgi import BrotliMiddleware
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import ORJSONResponse
-from fastapi.staticfiles import StaticFiles
 
-from .routers import collections, images, legal, thumbnails, users
+from .common.admission import AdmissionMiddleware, image_processing
+from .common.compression import CompressionMiddleware, PrecompressedStaticFiles
+from .common.compute import shutdown_executor
+from .common.image_cache import start_invalidation_bus, stop_invalidation_bus
+from .common.settings import api_settings
+from .common.tasks import cancel_tasks, run_periodically
+from .common.thumbnail_cache import evict_thumbnail_variants
+from .common.thumbnails import run_thumbnail_jobs
+from .routers import (collections, images, legal, metrics, thumbnails, uploads,
+                      users)
 
 app = FastAPI(
     title="Iamages",
@@ -19,22 +26,58 @@ app = FastAPI(
     default_response_class=ORJSONResponse
 )
 
+@app.on_event("startup")
+async def start_tasks():
+    run_periodically(uploads.collect_upload_sessions, 3600)
+    for _ in range(api_settings.thumbnail_workers):
+        run_periodically(run_thumbnail_jobs, api_settings.thumbnail_job_poll_interval)
+    run_periodically(evict_thumbnail_variants, api_settings.thumbnail_cache_eviction_interval)
+    start_invalidation_bus()
+
+app.add_event_handler("shutdown", cancel_tasks)
+app.add_event_handler("shutdown", shutdown_executor)
+app.add_event_handler("shutdown", stop_invalidation_bus)
+
 app.mount(
     "/private/static",
-    StaticFiles(directory=Path("./api/web/static")),
+    PrecompressedStaticFiles(directory=Path("./api/web/static")),
     name="static"
 )
 
 app.include_router(images.router)
+app.include_router(uploads.router)
 app.include_router(thumbnails.router)
 app.include_router(collections.router)
 app.include_router(users.router)
 app.include_router(legal.router)
+app.include_router(metrics.router)
 
+app.add_middleware(
+    AdmissionMiddleware,
+    rules=[
+        # Uploads and edits that lock, unlock or rekey the file.
+        ("POST", r"/images/(batch)?$", image_processing),
+        ("PATCH", r"/images/[^/]+$", image_processing),
+        ("POST", r"/uploads/[^/]+/finalize$", image_processing)
+    ]
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"]
 )
-app.add_middleware(BrotliMiddleware, gzip_fallback=True)
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=512,
+    default_level=4,
+    levels=[
+        # Image files are skipped by their types anyway,
+        # this saves looking at every chunk sent.
+        (r"/images/[^/]+\.\w+$", 0),
+        (r"/thumbnails/", 0),
+        # Listings are big and repetitive, worth a bit more work.
+        (r"/images(/suggestions)?/?$", 5),
+        (r"/collections(/suggestions)?/?$", 5)
+    ]
+)
@@ -2,7 +2,8 @@ from datetime import datetime
 from enum import Enum, IntEnum
 from uuid import UUID
 
-from pydantic import BaseModel, Field, constr, root_validator
+from bson.objectid import ObjectId
+from pydantic import BaseModel, Field, conlist, constr, root_validator
 
 from .default import DefaultModel, PyObjectId
 
@@ -16,14 +17,19 @@ class ImageMetadata(BaseModel):
 class File(BaseModel):
     content_type: str
     type_extension: str
+    hash: str | None
     salt: bytes | None
     nonce: bytes | None
     tag: bytes | None
+    modified_on: datetime | None
 
 
 class Thumbnail(BaseModel):
     is_computing: bool = Field(default_factory=lambda: False)
     is_unavailable: bool = Field(default_factory=lambda: False)
+    # Shown while the thumbnail loads, set once it's been created.
+    placeholder: str | None
+    color: str | None
 
 
 class ImageMetadataContainer(BaseModel):
@@ -35,6 +41,8 @@ class ImageMetadataContainer(BaseModel):
 
 class LockVersion(IntEnum):
     aes128gcm_argon2 = 1
+    aes128gcm_stream_argon2 = 2
+    aes128gcm_stream_argon2_hkdf = 3
 
 
 class Lock(BaseModel):
@@ -45,7 +53,7 @@ class Lock(BaseModel):
     @root_validator
     def get_upgradable(cls, values) -> dict:
         if values["version"]:
-            values["upgradable"] = values["version"] < LockVersion.aes128gcm_argon2
+            values["upgradable"] = values["version"] < max(LockVersion)
         return values
 
 
@@ -83,3 +91,25 @@ class ImageEditResponse(BaseModel):
     lock_version: LockVersion | None = None
     file: File | None = None
     metadata_salt: bytes | None = None
+
+class ImageBatchResult(BaseModel):
+    ok: bool = True
+    image: Image | None = None
+    ownerless_key: UUID | None = None
+    error: str | None = None
+
+    class Config:
+        json_encoders = {ObjectId: str}
+
+class ImageSignatureRequest(BaseModel):
+    ids: conlist(PyObjectId, min_items=1, max_items=100)
+
+class ImageSignature(BaseModel):
+    id: PyObjectId
+    expires: int
+    signature: str
+    file_url: str
+    thumbnail_url: str | None
+
+    class Config:
+        json_encoders = {ObjectId: str}
@@ -0,0 +1,20 @@
+from datetime import datetime
+from enum import Enum
+
+from .default import DefaultModel
+
+
+class ThumbnailJobState(str, Enum):
+    pending = "pending"
+    running = "running"
+    # Failed too many times, left for inspection.
+    dead = "dead"
+
+class ThumbnailJob(DefaultModel):
+    # Same as the image's id, there's at most one job per image.
+    state: ThumbnailJobState = ThumbnailJobState.pending
+    attempts: int = 0
+    available_on: datetime
+    lease_expires_on: datetime | None
+    error: str | None
+    created_on: datetime
@@ -0,0 +1,19 @@
+from datetime import datetime, timezone
+from uuid import UUID, uuid4
+
+from pydantic import BaseModel, Field, conint
+
+
+class UploadSession(BaseModel):
+    id: UUID = Field(default_factory=uuid4, alias="_id")
+    owner: str | None
+    content_type: str
+    size: conint(ge=1)
+    created_on: datetime = Field(default_factory=lambda: datetime.now(timezone.utc).replace(microsecond=0))
+
+    class Config:
+        allow_population_by_field_name = True
+
+class NewUploadSession(BaseModel):
+    content_type: str
+    size: conint(ge=1)
@@ -5,6 +5,7 @@ from fastapi.responses import HTMLResponse
 from pymongo import DESCENDING
 
 from ..common.db import db_collections, db_images
+from ..common.image_cache import invalidate_all_images, invalidate_images
 from ..common.security import get_optional_user, get_user
 from ..common.templates import templates
 from ..models.collections import (Collection, EditableCollectionInformation,
@@ -26,6 +27,7 @@ def add_images(collection_id: PyObjectId, image_ids: list[PyObjectId], user: Use
         if image_id in image.collections:
             continue
         db_images.update_one({"_id": image_id}, {"$push": {"collections": collection_id}})
+        invalidate_images([image_id])
 
 router = APIRouter(prefix="/collections")
 
@@ -109,6 +111,7 @@ def edit_collection(
                 raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="remove_images requires a list of ids 'to'.")
             for image_id in to:
                 db_images.update_one({"_id": image_id}, {"$pull": {"collections": id}})
+            invalidate_images(to)
 
 @router.delete(
     "/{id}",
@@ -124,6 +127,7 @@ def delete_collection(
         {"collection": id},
         {"$pull": {"collection": id}}
     )
+    invalidate_all_images()
 
 @router.get(
     "/{id}/embed",
@@ -148,6 +152,11 @@ def get_collection_embed(
 @router.post(
     "/{id}/images",
     response_model=list[Image],
+    response_model_exclude={
+        "file": {
+            "hash": ...
+        }
+    },
     response_model_by_alias=False,
     response_model_exclude_none=True
 )
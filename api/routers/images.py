@@ -1,35 +1,54 @@
+from asyncio import gather
 from base64 import b64decode, b64encode
+from datetime import datetime, timezone
 from mimetypes import guess_extension
 from secrets import compare_digest
-from shutil import copyfileobj
-from tempfile import SpooledTemporaryFile
-from typing import BinaryIO
+from time import perf_counter
+from traceback import print_exception
 from uuid import UUID, uuid4
 
-import magic
 import orjson
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 from fastapi import (APIRouter, Body, Depends, Form, Header, HTTPException,
                      Request, UploadFile, status)
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import FileResponse, HTMLResponse, Response
-from passlib.hash import argon2
-from PIL import Image as PillowImage
-from PIL.ImageOps import exif_transpose
+from fastapi.responses import HTMLResponse, Response
 from pydantic import Json
 from pydantic.json import ENCODERS_BY_TYPE
-
-from ..common.db import db_images
-from ..common.paths import IMAGES_PATH, THUMBNAILS_PATH
-from ..common.security import get_optional_user, get_user
+from starlette.datastructures import URL
+from starlette.concurrency import run_in_threadpool
+
+from ..common.admission import image_processing
+from ..common.blobs import acquire_blob, release_blob
+from ..common.caching import (get_file_cache_headers,
+                              get_file_last_modified, is_not_modified,
+                              not_modified_response)
+from ..common.compute import run_in_process
+from ..common.crypto import (SEGMENT_SIZE, decrypt_file, derive_lock_keys,
+                             encrypt_file, is_segmented, new_file_nonce,
+                             reencrypt_file)
+from ..common.db import db_collections, db_images
+from ..common.image_cache import find_image, invalidate_images
+from ..common.imaging import prepare_image
+from ..common.ingest import (IngestedFile, discard_file, hash_file,
+                             ingest_file, new_temporary_path)
+from ..common.paths import IMAGES_PATH, get_image_file_name
+from ..common.responses import RangeFileResponse
+from ..common.security import (ImageAccess, get_image_access,
+                               get_optional_user, get_user)
 from ..common.settings import api_settings
+from ..common.signing import get_signature_expiry, sign_image
+from ..common.storage import storage
 from ..common.templates import templates
+from ..common.thumbnail_cache import delete_thumbnails
+from ..common.thumbnails import enqueue_thumbnails
 from ..models.default import PyObjectId
 from ..models.images import (EditableImageInformation, File, Image,
-                             ImageEditResponse, ImageInDB, ImageMetadata,
-                             ImageMetadataContainer, ImageUpload, Lock,
-                             LockVersion, Thumbnail)
+                             ImageBatchResult, ImageEditResponse, ImageInDB,
+                             ImageMetadata, ImageMetadataContainer,
+                             ImageSignature, ImageSignatureRequest,
+                             ImageUpload, Lock, LockVersion, Thumbnail)
 from ..models.users import User
 
 ENCODERS_BY_TYPE[bytes] = lambda b: b64encode(b).decode("utf-8")
@@ -41,40 +60,13 @@ SUPPORTED_MIME_TYPES = [
     "image/webp"
 ]
 
-def check_file_size(file: BinaryIO) -> int:
-    real_file_size = 0
-    for chunk in file:
-        real_file_size += len(chunk)
-        if real_file_size > api_settings.max_size:
-            raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
-    file.seek(0)
-    return real_file_size
-
-def hash_password(key: str, salt: bytes = None) -> tuple[bytes, bytes]:
-    # Follow recommended rfc9106 parameters.
-    hasher = argon2.using(
-        salt=salt,
-        salt_len=16 if not salt else None, 
-        hash_len=16,
-        time_cost=3,
-        memory_cost=65536,
-        parallelism=4
-    )
-    hashed_key = hasher.hash(key).split("$")
-    # Incorrect padding fix.
-    return (b64decode(hashed_key[-1] + "=="), b64decode(hashed_key[-2] + "=="))
-
-def get_image_in_db(id: PyObjectId, user: User | None) -> ImageInDB:
-    image_dict = db_images.find_one({
-        "_id": id
-    })
+def get_image_in_db(id: PyObjectId, user: User | None, is_signed: bool = False) -> ImageInDB:
+    image = find_image(id)
 
-    if not image_dict:
+    if not image:
         raise HTTPException(status.HTTP_404_NOT_FOUND)
 
-    image = ImageInDB.parse_obj(image_dict)
-
-    if image.is_private and (not user or image.owner != user.username):
+    if image.is_private and not is_signed and (not user or image.owner != user.username):
         raise HTTPException(status.HTTP_401_UNAUTHORIZED, detail="You don't have permission to view this image.")
 
     return image
@@ -85,6 +77,103 @@ def check_key_len(key: str) -> bytes:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Metadata lock key is not exactly 16 bytes.")
     return key_bytes
 
+def check_upload_information(information: ImageUpload, user: User | None):
+    if information.is_locked and not information.lock_key:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Lock key not set for locked image.")
+
+    if information.is_private and not user:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="You cannot set file to private without being logged in.")
+
+async def store_upload(
+    ingested: IngestedFile,
+    content_type: str,
+    information: ImageUpload,
+    user: User | None
+) -> tuple[ImageInDB, str]:
+    """
+    Validates, prepares and encrypts (if locked) an ingested upload,
+    then commits it to storage. Returns the image to be inserted along
+    with its Server-Timing entry. The ingested file is discarded on failure.
+    """
+    try:
+        mime = ingested.mime
+        if mime != content_type:
+            raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="File MIME type doesn't match what's given in the request.")
+        if not mime in SUPPORTED_MIME_TYPES:
+            raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="We only accept JPEG, PNG, GIF and WebP formats.")
+
+        prepare_start = perf_counter()
+        prepared_image = await run_in_process(prepare_image, ingested.path)
+        server_timing = "prepare;desc=\"{}\";dur={:.1f}".format(
+            prepared_image.action,
+            (perf_counter() - prepare_start) * 1000
+        )
+
+        image_metadata = ImageMetadata(
+            description=information.description,
+            width=prepared_image.width,
+            height=prepared_image.height,
+            real_content_type=mime if information.is_locked else None
+        )
+
+        metadata_salt = None
+        metadata_nonce = None
+        metadata_tag = None
+
+        if information.is_locked:
+            image_metadata_bytes = orjson.dumps(image_metadata.dict(exclude_none=True))
+            # One key derivation for both the metadata and file keys.
+            metadata_key, file_key, metadata_salt = await run_in_process(derive_lock_keys, information.lock_key)
+
+            metadata_nonce = get_random_bytes(12)
+
+            cipher = AES.new(metadata_key, AES.MODE_GCM, nonce=metadata_nonce)
+
+            image_metadata_bytes, metadata_tag = cipher.encrypt_and_digest(image_metadata_bytes)
+
+        image = ImageInDB(
+            is_private=information.is_private,
+            lock=Lock(
+                is_locked=information.is_locked,
+                version=max(LockVersion) if information.is_locked else None
+            ),
+            file=File(
+                content_type="application/octet-stream" if information.is_locked else mime,
+                type_extension=guess_extension("application/octet-stream") if information.is_locked else guess_extension(mime)
+            ),
+            metadata=ImageMetadataContainer(
+                salt=metadata_salt,
+                nonce=metadata_nonce,
+                data=image_metadata_bytes if information.is_locked else image_metadata,
+                tag=metadata_tag,
+            )
+        )
+        if user:
+            image.owner = user.username
+        else:
+            image.ownerless_key = uuid4()
+        if not information.is_locked:
+            image.thumbnail = Thumbnail()
+
+        if information.is_locked:
+            image.file.salt = metadata_salt
+
+            file_nonce = new_file_nonce()
+            image.file.nonce = file_nonce
+
+            await run_in_process(encrypt_file, ingested.path, ingested.path, file_key, file_nonce)
+
+        if api_settings.deduplicate_storage and not information.is_locked:
+            image.file.hash = prepared_image.hash or ingested.hash
+            await run_in_threadpool(acquire_blob, ingested.path, image.file.hash, image.file.type_extension)
+        else:
+            await run_in_threadpool(storage.put, ingested.path, IMAGES_PATH, get_image_file_name(image.id, image.file.type_extension))
+    except BaseException:
+        discard_file(ingested.path)
+        raise
+
+    return image, server_timing
+
 router = APIRouter(prefix="/images")
 
 @router.post(
@@ -92,6 +181,7 @@ router = APIRouter(prefix="/images")
     response_model=Image,
     response_model_exclude={
         "file": {
+            "hash": ...,
             "salt": ...,
             "nonce": ...,
             "tag": ...
@@ -100,148 +190,186 @@ router = APIRouter(prefix="/images")
     },
     response_model_by_alias=False,
     response_model_exclude_unset=True,
-    status_code=status.HTTP_201_CREATED
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(image_processing)]
 )
-def upload_image(
+async def upload_image(
     file: UploadFile,
     response: Response,
     information: Json[ImageUpload] = Form(),
     user: User | None = Depends(get_optional_user)
 ):
-    if information.is_locked and not information.lock_key:
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Lock key not set for locked image.")
-
-    if information.is_private and not user:
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="You cannot set file to private without being logged in.")
-        
-    
-    size = check_file_size(file.file)
-
-    mime = magic.from_buffer(file.file.read(2048 if size >= 2048 else size), mime=True)
-    if mime != file.content_type:
-        raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="File MIME type doesn't match what's given in the request.")
-    if not mime in SUPPORTED_MIME_TYPES:
-        raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="We only accept JPEG, PNG, GIF and WebP formats.")
-
-    file.file.seek(0)
-
-    original_pil_image = PillowImage.open(file.file)
-    # Correct orientation
-    transposed_pil_image = exif_transpose(original_pil_image)
-    width, height = transposed_pil_image.size
-    transposed_pil_image.format = original_pil_image.format
-    original_pil_image.close()
-
-    image_metadata = ImageMetadata(
-        description=information.description,
-        width=width,
-        height=height,
-        real_content_type=mime if information.is_locked else None
-    )
-
-    metadata_salt = None
-    metadata_nonce = None
-    metadata_tag = None
-
-    if information.is_locked:
-        image_metadata_bytes = orjson.dumps(image_metadata.dict(exclude_none=True))
-        metadata_key, metadata_salt = hash_password(information.lock_key)
-
-        metadata_nonce = get_random_bytes(12)
-
-        cipher = AES.new(metadata_key, AES.MODE_GCM, nonce=metadata_nonce)
-
-        image_metadata_bytes, metadata_tag = cipher.encrypt_and_digest(image_metadata_bytes)
-
-    image = ImageInDB(
-        is_private=information.is_private,
-        lock=Lock(
-            is_locked=information.is_locked,
-            version=LockVersion.aes128gcm_argon2 if information.is_locked else None
-        ),
-        file=File(
-            content_type="application/octet-stream" if information.is_locked else mime,
-            type_extension=guess_extension("application/octet-stream") if information.is_locked else guess_extension(mime)
-        ),
-        metadata=ImageMetadataContainer(
-            salt=metadata_salt,
-            nonce=metadata_nonce,
-            data=image_metadata_bytes if information.is_locked else image_metadata,
-            tag=metadata_tag,
-        )
-    )
-    if user:
-        image.owner = user.username
-    else:
-        ownerless_key = uuid4()
-        image.ownerless_key = ownerless_key
-        response.headers["X-Iamages-Ownerless-Key"] = str(ownerless_key)
-    if not information.is_locked:
-        image.thumbnail = Thumbnail()
-
-    with SpooledTemporaryFile() as temporary:
-        transposed_pil_image.save(temporary, format=transposed_pil_image.format, save_all=getattr(transposed_pil_image, "is_animated", False))
-        transposed_pil_image.close()
-
-        if information.is_locked:
-            file_key, file_salt = hash_password(information.lock_key)
-            image.file.salt = file_salt
-
-            file_nonce = get_random_bytes(12)
-            image.file.nonce = file_nonce
-
-            cipher = AES.new(file_key, AES.MODE_GCM, nonce=file_nonce)
+    check_upload_information(information, user)
 
-            temporary.seek(0)
-            encrypted_image_bytes, file_tag = cipher.encrypt_and_digest(temporary.read())
-            image.file.tag = file_tag
-            temporary.seek(0)
-            temporary.write(encrypted_image_bytes)
+    ingested = await run_in_threadpool(ingest_file, file.file, IMAGES_PATH, api_settings.max_size)
+    image, server_timing = await store_upload(ingested, file.content_type, information, user)
 
-        temporary.seek(0)
+    response.headers["Server-Timing"] = server_timing
+    if image.ownerless_key:
+        response.headers["X-Iamages-Ownerless-Key"] = str(image.ownerless_key)
 
-        with open(IMAGES_PATH / f"{image.id}{image.file.type_extension}", "wb") as image_file:
-            copyfileobj(temporary, image_file)
-
-    db_images.insert_one(
+    await run_in_threadpool(
+        db_images.insert_one,
         image.dict(by_alias=True, exclude_none=True, exclude={
             "created_on": ...,
             "lock": {"upgradable": ...}
         })
     )
+    if image.thumbnail:
+        await run_in_threadpool(enqueue_thumbnails, [image.id])
 
     return image.dict()
 
+@router.post(
+    "/batch",
+    response_model=list[ImageBatchResult],
+    response_model_exclude={
+        "image": {
+            "file": {
+                "hash": ...,
+                "salt": ...,
+                "nonce": ...,
+                "tag": ...
+            },
+            "metadata": ...
+        }
+    },
+    response_model_by_alias=False,
+    response_model_exclude_none=True,
+    description="Uploads many images at once. Each file is paired with the information field at the same position.",
+    dependencies=[Depends(image_processing)]
+)
+async def upload_images(
+    files: list[UploadFile],
+    information: list[Json[ImageUpload]] = Form(),
+    collection_id: PyObjectId | None = Form(None),
+    user: User | None = Depends(get_optional_user)
+):
+    if len(files) != len(information):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Every file needs exactly one information object.")
+    if len(files) > api_settings.max_batch_size:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=f"Upload at most {api_settings.max_batch_size} images at once.")
+
+    if collection_id:
+        if not user:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="You cannot add images to a collection without being logged in.")
+        collection_dict = await run_in_threadpool(db_collections.find_one, {"_id": collection_id}, {"owner": 1})
+        if not collection_dict:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Collection doesn't exist.")
+        if not compare_digest(collection_dict["owner"], user.username):
+            raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You don't have permission to modify this collection.")
+
+    async def upload_one(file: UploadFile, file_information: ImageUpload) -> ImageInDB | HTTPException:
+        try:
+            check_upload_information(file_information, user)
+            ingested = await run_in_threadpool(ingest_file, file.file, IMAGES_PATH, api_settings.max_size)
+            image, _ = await store_upload(ingested, file.content_type, file_information, user)
+        except HTTPException as e:
+            return e
+        except Exception as e:
+            print_exception(e)
+            return HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Could not process this image.")
+        if collection_id:
+            image.collections = [collection_id]
+        return image
+
+    uploads = await gather(*map(upload_one, files, information))
+
+    images = [upload for upload in uploads if isinstance(upload, ImageInDB)]
+    if images:
+        await run_in_threadpool(
+            db_images.insert_many,
+            [
+                image.dict(by_alias=True, exclude_none=True, exclude={
+                    "created_on": ...,
+                    "lock": {"upgradable": ...}
+                })
+                for image in images
+            ]
+        )
+        await run_in_threadpool(enqueue_thumbnails, [image.id for image in images if image.thumbnail])
+
+    return [
+        ImageBatchResult(image=upload, ownerless_key=upload.ownerless_key)
+        if isinstance(upload, ImageInDB)
+        else ImageBatchResult(ok=False, error=upload.detail)
+        for upload in uploads
+    ]
+
+@router.post(
+    "/signatures",
+    response_model=list[ImageSignature],
+    description="Signs the file and thumbnail URLs of many images, so they can be viewed without a token until they expire. Images that don't exist or that you can't view are left out."
+)
+def sign_images(
+    signature_request: ImageSignatureRequest,
+    request: Request,
+    user: User | None = Depends(get_optional_user)
+):
+    expires = get_signature_expiry()
+    signatures = []
+    for image_dict in db_images.find({"_id": {"$in": signature_request.ids}}, {
+        "owner": 1,
+        "is_private": 1,
+        "lock.is_locked": 1,
+        "file.type_extension": 1
+    }):
+        if image_dict["is_private"] and (not user or image_dict.get("owner") != user.username):
+            continue
+        id = image_dict["_id"]
+        signature = sign_image(id, expires)
+        extension = image_dict["file"]["type_extension"].lstrip(".")
+        file_url = URL(request.url_for("get_image_file", id=id, extension=extension))
+        thumbnail_url = URL(request.url_for("get_thumbnail", id=id, extension=extension))
+        signatures.append(ImageSignature(
+            id=id,
+            expires=expires,
+            signature=signature,
+            file_url=str(file_url.include_query_params(expires=expires, signature=signature)),
+            thumbnail_url=None if image_dict["lock"]["is_locked"] else str(
+                thumbnail_url.include_query_params(expires=expires, signature=signature)
+            )
+        ))
+    return signatures
+
 @router.api_route(
     "/{id}.{extension}",
     methods=["GET", "HEAD"],
-    response_class=FileResponse
+    response_class=RangeFileResponse
 )
 def get_image_file(
     id: PyObjectId,
     extension: str,
-    user: User | None = Depends(get_optional_user)
+    request: Request,
+    access: ImageAccess = Depends(get_image_access)
 ):
-    image = get_image_in_db(id, user)
+    image = get_image_in_db(id, access.user, access.is_signed)
 
     if image.file.type_extension.lstrip(".") != extension:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Wrong file extension.")
 
-    headers = {
-        "Cache-Control": "public, max-age=86400"
-    }
+    headers = get_file_cache_headers(image, expires=access.expires)
+    if is_not_modified(request.headers, headers["ETag"], get_file_last_modified(image)):
+        return not_modified_response(headers)
 
     if image.lock.is_locked:
         headers["X-Iamages-Lock-Salt"] = b64encode(image.file.salt).decode("utf-8")
         headers["X-Iamages-Lock-Nonce"] = b64encode(image.file.nonce).decode("utf-8")
-        headers["X-Iamages-Lock-Tag"] = b64encode(image.file.tag).decode("utf-8")
-
-    image_file_name = f"{id}{image.file.type_extension}"
-    return FileResponse(
-        IMAGES_PATH / image_file_name,
-        media_type=image.file.content_type,
+        headers["X-Iamages-Lock-Version"] = str(image.lock.version.value)
+        if is_segmented(image.lock.version):
+            headers["X-Iamages-Lock-Segment-Size"] = str(SEGMENT_SIZE)
+        else:
+            headers["X-Iamages-Lock-Tag"] = b64encode(image.file.tag).decode("utf-8")
+
+    # Locked files can't be redirected to storage, their lock headers would be lost.
+    return storage.get_response(
+        IMAGES_PATH,
+        get_image_file_name(id, image.file.type_extension, image.file.hash),
+        request,
         headers=headers,
-        filename=image_file_name
+        media_type=image.file.content_type,
+        filename=f"{id}{image.file.type_extension}",
+        allow_redirect=not image.lock.is_locked
     )
 
 @router.api_route(
@@ -250,6 +378,7 @@ def get_image_file(
     response_model=Image,
     response_model_exclude={
         "file": {
+            "hash": ...,
             "salt": ...,
             "nonce": ...,
             "tag": ...
@@ -280,7 +409,8 @@ def get_image_metadata(
             "Content-Length": str(len(image.metadata.data)),
             "X-Iamages-Lock-Salt": b64encode(image.metadata.salt).decode("utf-8"),
             "X-iamages-Lock-Nonce": b64encode(image.metadata.nonce).decode("utf-8"),
-            "X-Iamages-Lock-Tag": b64encode(image.metadata.tag).decode("utf-8")
+            "X-Iamages-Lock-Tag": b64encode(image.metadata.tag).decode("utf-8"),
+            "X-Iamages-Lock-Version": str(image.lock.version.value)
         })
     return image.metadata.data
 
@@ -304,6 +434,9 @@ def get_image_embed(
                 "lock": {
                     "upgradable": ...
                 },
+                "file": {
+                    "hash": ...
+                },
                 "collections": ...
             }
         ),
@@ -340,23 +473,23 @@ def delete_image(
             raise HTTPException(status.HTTP_401_UNAUTHORIZED, detail="You don't have permission to delete this image.")
 
     db_images.find_one_and_delete({"_id": id})
+    invalidate_images([id])
 
-    image_file_name = f"{id}{image.file.type_extension}"
-    try:
-        (IMAGES_PATH / image_file_name).unlink()
-    except FileNotFoundError:
-        pass
-    try:
-        (THUMBNAILS_PATH / image_file_name).unlink()
-    except FileNotFoundError:
-        pass
+    if image.file.hash:
+        release_blob(image.file.hash, image.file.type_extension)
+        return
+
+    image_file_name = get_image_file_name(id, image.file.type_extension)
+    storage.delete(IMAGES_PATH, image_file_name)
+    delete_thumbnails(image_file_name)
 
 @router.patch(
     "/{id}",
     response_model=ImageEditResponse,
-    response_model_exclude_none=True
+    response_model_exclude_none=True,
+    dependencies=[Depends(image_processing)]
 )
-def patch_image_information(
+async def patch_image_information(
     id: PyObjectId,
     change: EditableImageInformation = Body(...),
     to: bool | str = Body(...),
@@ -364,7 +497,7 @@ def patch_image_information(
     image_lock_key: str | None = Body(None),
     user: User = Depends(get_user)
 ):
-    image_dict = db_images.find_one({"_id": id})
+    image_dict = await run_in_threadpool(db_images.find_one, {"_id": id})
     if not image_dict:
         raise HTTPException(status.HTTP_404_NOT_FOUND)
     image = ImageInDB.parse_obj(image_dict)
@@ -376,11 +509,12 @@ def patch_image_information(
         case EditableImageInformation.is_private:
             if type(to) != bool:
                 raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="is_private requires a boolean 'to'.")
-            db_images.update_one({"_id": id}, {
+            await run_in_threadpool(db_images.update_one, {"_id": id}, {
                 "$set": {
                     "is_private": to
                 }
             })
+            invalidate_images([id])
             return ImageEditResponse()
         case EditableImageInformation.description:
             if type(to) != str:
@@ -416,7 +550,8 @@ def patch_image_information(
                     "metadata": metadata_object.dict(exclude_none=True)
                 }
             }
-            db_images.update_one({"_id": id}, update_dict)
+            await run_in_threadpool(db_images.update_one, {"_id": id}, update_dict)
+            invalidate_images([id])
             return ImageEditResponse()
         case EditableImageInformation.lock:
             if image.lock.is_locked and (not metadata_lock_key or not image_lock_key):
@@ -436,51 +571,65 @@ def patch_image_information(
                     image.metadata.data.real_content_type = image.file.content_type
                     metadata_data = orjson.dumps(image.metadata.data.dict(exclude_none=True))
 
-                metadata_key, metadata_salt = hash_password(to)
+                metadata_key, file_key, metadata_salt = await run_in_process(derive_lock_keys, to)
+                file_salt = metadata_salt
                 metadata_nonce = get_random_bytes(12)
                 cipher = AES.new(metadata_key, AES.MODE_GCM, nonce=metadata_nonce)
                 metadata_data, metadata_tag = cipher.encrypt_and_digest(metadata_data)
 
                 # Re-encrypt existing image file by decrypting using lock_key
                 # and encrypting using to key.
-                file_name = f"{id}{image.file.type_extension}"
-                if image.lock.is_locked:
-                    cipher = AES.new(
-                        check_key_len(image_lock_key),
-                        AES.MODE_GCM,
-                        nonce=image.file.nonce
-                    )
-                    with open(IMAGES_PATH / file_name, "rb") as file:
-                        file_data = cipher.decrypt_and_verify(file.read(), image.file.tag)
-                else:
-                    with open(IMAGES_PATH / file_name, "rb") as file:
-                        file_data = file.read()
-
-                file_key, file_salt = hash_password(to)
-                file_nonce = get_random_bytes(12)
-                cipher = AES.new(file_key, AES.MODE_GCM, nonce=file_nonce)
-                file_data, file_tag = cipher.encrypt_and_digest(file_data)
+                file_name = get_image_file_name(id, image.file.type_extension, image.file.hash)
+                file_nonce = new_file_nonce()
 
                 new_file_extension = guess_extension("application/octet-stream")
-                if not image.lock.is_locked:
-                    (IMAGES_PATH / file_name).unlink()
-                with open(IMAGES_PATH / f"{id}{new_file_extension}", "wb") as image_file:
-                    image_file.write(file_data)
-
-                db_images.update_one({
+                new_file_name = get_image_file_name(id, new_file_extension)
+                new_file_path = new_temporary_path(IMAGES_PATH)
+                try:
+                    async with storage.open_local(IMAGES_PATH, file_name) as file_path:
+                        if image.lock.is_locked:
+                            await run_in_process(
+                                reencrypt_file,
+                                file_path,
+                                new_file_path,
+                                check_key_len(image_lock_key),
+                                image.file.nonce,
+                                image.file.tag,
+                                image.lock.version,
+                                file_key,
+                                file_nonce
+                            )
+                        else:
+                            await run_in_process(
+                                encrypt_file,
+                                file_path,
+                                new_file_path,
+                                file_key,
+                                file_nonce
+                            )
+                    await run_in_threadpool(storage.put, new_file_path, IMAGES_PATH, new_file_name)
+                except BaseException:
+                    discard_file(new_file_path)
+                    raise
+                if image.file.hash:
+                    await run_in_threadpool(release_blob, image.file.hash, image.file.type_extension)
+                elif file_name != new_file_name:
+                    await run_in_threadpool(storage.delete, IMAGES_PATH, file_name)
+
+                await run_in_threadpool(db_images.update_one, {
                     "_id": id
                 }, {
                     "$set": {
                         "lock": {
                             "is_locked": True,
-                            "version": LockVersion.aes128gcm_argon2
+                            "version": max(LockVersion)
                         },
                         "file": {
                             "content_type": "application/octet-stream",
                             "type_extension": new_file_extension,
                             "salt": file_salt,
                             "nonce": file_nonce,
-                            "tag": file_tag
+                            "modified_on": datetime.now(timezone.utc)
                         },
                         "metadata": {
                             "salt": metadata_salt,
@@ -493,16 +642,13 @@ def patch_image_information(
                         "thumbnail": None
                     }
                 })
+                invalidate_images([id])
 
-                try:
-                    (THUMBNAILS_PATH / file_name).unlink()
-                except FileNotFoundError:
-                    pass
-                except Exception as e:
-                    raise e
+                if not image.file.hash:
+                    await run_in_threadpool(delete_thumbnails, file_name)
 
                 return ImageEditResponse(
-                    lock_version=LockVersion.aes128gcm_argon2,
+                    lock_version=max(LockVersion),
                     file=File(
                         content_type="application/octet-stream",
                         type_extension=new_file_extension,
@@ -521,30 +667,39 @@ def patch_image_information(
                 content_type = metadata_data.real_content_type
                 metadata_data.real_content_type = None
 
-                cipher = AES.new(
-                    check_key_len(image_lock_key),
-                    AES.MODE_GCM,
-                    nonce=image.file.nonce
-                )
-                file_name = f"{id}{image.file.type_extension}"
+                file_name = get_image_file_name(id, image.file.type_extension)
                 new_file_extension = guess_extension(content_type)
-                with (
-                    open(IMAGES_PATH / file_name, "rb") as encrypted_file,
-                    open(IMAGES_PATH / f"{id}{new_file_extension}", "wb") as decrypted_file
-                ):
-                    decrypted_file.write(
-                        cipher.decrypt_and_verify(encrypted_file.read(), image.file.tag)
-                    )
-
-                (IMAGES_PATH / file_name).unlink()
-
-                db_images.update_one({
-                    "_id": id
-                }, {
+                decrypted_path = new_temporary_path(IMAGES_PATH)
+                file_hash = None
+                try:
+                    async with storage.open_local(IMAGES_PATH, file_name) as file_path:
+                        await run_in_process(
+                            decrypt_file,
+                            file_path,
+                            decrypted_path,
+                            check_key_len(image_lock_key),
+                            image.file.nonce,
+                            image.file.tag,
+                            image.lock.version
+                        )
+
+                    if api_settings.deduplicate_storage:
+                        file_hash = await run_in_threadpool(hash_file, decrypted_path)
+                        await run_in_threadpool(acquire_blob, decrypted_path, file_hash, new_file_extension)
+                    else:
+                        await run_in_threadpool(storage.put, decrypted_path, IMAGES_PATH, get_image_file_name(id, new_file_extension))
+                except BaseException:
+                    discard_file(decrypted_path)
+                    raise
+
+                await run_in_threadpool(storage.delete, IMAGES_PATH, file_name)
+
+                update_dict = {
                     "$set": {
                         "lock.is_locked": False,
                         "file.content_type": content_type,
                         "file.type_extension": new_file_extension,
+                        "file.modified_on": datetime.now(timezone.utc),
                         "metadata.data": metadata_data.dict(exclude_none=True),
                         "thumbnail": Thumbnail().dict()
                     },
@@ -557,7 +712,12 @@ def patch_image_information(
                         "metadata.nonce": None,
                         "metadata.tag": None
                     }
-                })
+                }
+                if file_hash:
+                    update_dict["$set"]["file.hash"] = file_hash
+                await run_in_threadpool(db_images.update_one, {"_id": id}, update_dict)
+                invalidate_images([id])
+                await run_in_threadpool(enqueue_thumbnails, [id])
 
                 return ImageEditResponse(
                     file=File(
@@ -0,0 +1,35 @@
+from fastapi import APIRouter
+
+from ..common import admission
+from ..common.image_cache import image_cache
+from ..common.security import token_cache
+from ..common.thumbnail_cache import thumbnail_index
+from ..common.thumbnails import get_thumbnail_job_stats
+from ..common.user_cache import unknown_user_cache, user_cache
+
+router = APIRouter(
+    prefix="/private/metrics"
+)
+
+@router.get(
+    "/",
+    include_in_schema=False,
+    description="Counters of the server worker answering the request."
+)
+def get_metrics():
+    return {
+        "image_cache": image_cache.stats(),
+        "token_cache": token_cache.stats(),
+        "user_cache": user_cache.stats(),
+        "unknown_user_cache": unknown_user_cache.stats(),
+        "admission": {
+            controller.name: controller.stats()
+            for controller in [
+                admission.image_processing,
+                admission.password_hashing,
+                admission.thumbnail_variants
+            ]
+        },
+        "thumbnail_jobs": get_thumbnail_job_stats(),
+        "thumbnail_cache": thumbnail_index.stats()
+    }
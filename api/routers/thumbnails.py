@@ -1,92 +1,165 @@
 from secrets import compare_digest
-from shutil import copyfileobj
-from tempfile import SpooledTemporaryFile
 from traceback import print_exception
 
-from fastapi import APIRouter, Depends, HTTPException, Request, status
-from fastapi.responses import FileResponse, RedirectResponse
-from PIL import Image as PillowImage
-from PIL.Image import LANCZOS
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import FileResponse, RedirectResponse, Response
+from starlette.datastructures import URL
+from starlette.concurrency import run_in_threadpool
 
+from ..common.caching import (get_file_cache_headers,
+                              get_file_last_modified, is_not_modified,
+                              not_modified_response)
 from ..common.db import db_images
-from ..common.paths import IMAGES_PATH, THUMBNAILS_PATH
-from ..common.security import get_optional_user
+from ..common.image_cache import find_image
+from ..common.admission import thumbnail_variants
+from ..common.paths import (THUMBNAILS_PATH, get_image_file_name,
+                            get_thumbnail_file_name)
+from ..common.security import ImageAccess, get_image_access
+from ..common.settings import api_settings
+from ..common.storage import storage
+from ..common.thumbnail_cache import thumbnail_index
+from ..common.thumbnails import (create_thumbnail_variant,
+                                 ensure_thumbnail_job, wait_for_thumbnail)
 from ..models.default import PyObjectId
 from ..models.images import ImageInDB
-from ..models.users import User
-
-
-def set_unavailable(id: PyObjectId):
-    db_images.update_one({
-        "_id": id
-    }, {
-        "$set": {
-            "thumbnail": {
-                "is_computing": False,
-                "is_unavailable": True
-            }
-        }
-    })
 
-def create_thumbnail(image: ImageInDB):
-    db_images.update_one({"_id": image.id}, {
-        "$set": {
-            "thumbnail.is_computing": True
-        }
-    })
 
-    try:
-        file_name = f"{image.id}{image.file.type_extension}"
-        with SpooledTemporaryFile() as temporary:
-            image_file_path = IMAGES_PATH / file_name
-
-            pil_image = PillowImage.open(image_file_path)
-            pil_image.thumbnail((512, 512), LANCZOS)
-            pil_image.save(temporary, pil_image.format, save_all=getattr(pil_image, "is_animated", False))
-            pil_image.close()
-
-            if image_file_path.stat().st_size < temporary.tell():
-                set_unavailable(image.id)
-                return False
-
-            temporary.seek(0)
-
-            with open(THUMBNAILS_PATH / file_name, "wb") as thumbnail_file:
-                copyfileobj(temporary, thumbnail_file)
-
-        db_images.update_one({"_id": image.id}, {
-            "$set": {
-                "thumbnail.is_computing": False
-            }
-        })
-        return True
-    except Exception as e:
-        set_unavailable(image.id)
-        raise e
-
-def return_file_response(image: ImageInDB) -> FileResponse:
-    file_name = f"{image.id}{image.file.type_extension}"
-    path = THUMBNAILS_PATH / file_name
-    if not path.exists():
+def get_accepted_format(request: Request, image: ImageInDB) -> str | None:
+    # Browsers send */* as well, only formats listed by name count.
+    accepted = set()
+    for media_range in request.headers.get("accept", "").lower().split(","):
+        media_type, *parameters = media_range.split(";")
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if quality > 0:
+            accepted.add(media_type.strip())
+    for format in api_settings.thumbnail_formats:
+        if f"image/{format}" in accepted and image.file.type_extension != f".{format}":
+            return format
+    return None
+
+def get_cache_variant(size: int, format: str | None) -> str:
+    variant = "thumbnail"
+    if size != api_settings.thumbnail_default_size:
+        variant += f"@{size}"
+    if format:
+        variant += f".{format}"
+    return variant
+
+def get_vary_headers() -> dict[str, str]:
+    # Responses depend on Accept as soon as there are formats to negotiate.
+    return {"Vary": "Accept"} if api_settings.thumbnail_formats else {}
+
+def return_file_response(image: ImageInDB, request: Request, access: ImageAccess, size: int, format: str | None = None) -> Response:
+    file_name = get_thumbnail_file_name(get_image_file_name(image.id, image.file.type_extension, image.file.hash), size, format)
+    if not storage.exists(THUMBNAILS_PATH, file_name):
         raise FileNotFoundError()
-    return FileResponse(
-        path,
-        filename=file_name,
-        media_type=image.file.content_type,
+    if size != api_settings.thumbnail_default_size or format:
+        thumbnail_index.touch(file_name)
+    return storage.get_response(
+        THUMBNAILS_PATH,
+        file_name,
+        request,
         headers={
-            "Cache-Control": "public, max-age=86400"
-        }
+            **get_file_cache_headers(image, get_cache_variant(size, format), access.expires),
+            **get_vary_headers()
+        },
+        media_type=f"image/{format}" if format else image.file.content_type,
+        filename=f"{image.id}.{format}" if format else f"{image.id}{image.file.type_extension}"
     )
 
-def return_redirect_response(image: ImageInDB, request: Request) -> RedirectResponse:
+def get_file_url(image: ImageInDB, request: Request, access: ImageAccess) -> str:
+    url = URL(request.url_for("get_image_file", id=image.id, extension=image.file.type_extension.lstrip(".")))
+    # Signed thumbnail URLs are good for the file as well.
+    if access.is_signed:
+        url = url.include_query_params(expires=access.expires, signature=access.signature)
+    return str(url)
+
+def return_redirect_response(image: ImageInDB, request: Request, access: ImageAccess) -> RedirectResponse:
     return RedirectResponse(
-        request.url_for("get_image_file", id=image.id, extension=image.file.type_extension.lstrip(".")),
+        get_file_url(image, request, access),
         status.HTTP_308_PERMANENT_REDIRECT,
         headers={
-            "X-Iamages-Image-Private": str(image.is_private)
+            "X-Iamages-Image-Private": str(image.is_private),
+            **get_vary_headers()
         }
     )
 
+def return_pending_response(image: ImageInDB, request: Request, access: ImageAccess) -> RedirectResponse:
+    # Temporary, unlike return_redirect_response, since the thumbnail is coming.
+    return RedirectResponse(get_file_url(image, request, access), headers={
+        "X-Iamages-Image-Private": str(image.is_private),
+        **get_vary_headers()
+    })
+
+async def return_default_response(image: ImageInDB, request: Request, access: ImageAccess) -> Response:
+    size = api_settings.thumbnail_default_size
+    try:
+        if not image.thumbnail.is_computing:
+            return await run_in_threadpool(return_file_response, image, request, access, size)
+    except FileNotFoundError:
+        if image.thumbnail.is_unavailable:
+            return return_redirect_response(image, request, access)
+        # Queued when the image was uploaded, unless that was before
+        # thumbnail jobs existed or the job was lost.
+        await run_in_threadpool(ensure_thumbnail_job, image.id)
+    except Exception as e:
+        print_exception(e)
+        return return_redirect_response(image, request, access)
+
+    # Being created, by this request or one before it.
+    if not await wait_for_thumbnail(image.id):
+        return return_pending_response(image, request, access)
+    image_dict = await run_in_threadpool(db_images.find_one, {"_id": image.id})
+    if not image_dict:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Image doesn't exist.")
+    image = ImageInDB.parse_obj(image_dict)
+    try:
+        return await run_in_threadpool(return_file_response, image, request, access, size)
+    except FileNotFoundError:
+        if image.thumbnail and image.thumbnail.is_unavailable:
+            return return_redirect_response(image, request, access)
+        return return_pending_response(image, request, access)
+    except Exception as e:
+        print_exception(e)
+        return return_redirect_response(image, request, access)
+
+async def return_variant_response(image: ImageInDB, size: int, format: str | None, request: Request, access: ImageAccess) -> Response:
+    # Other formats are still made for images whose thumbnail in their own
+    # format was bigger than them, like PNG photos.
+    if image.thumbnail.is_unavailable and not format:
+        return return_redirect_response(image, request, access)
+    try:
+        return await run_in_threadpool(return_file_response, image, request, access, size, format)
+    except FileNotFoundError:
+        pass
+    # Made from the default thumbnail once it's there.
+    if size == api_settings.thumbnail_default_size and not image.thumbnail.is_unavailable:
+        if image.thumbnail.is_computing or not await run_in_threadpool(storage.exists, THUMBNAILS_PATH, get_image_file_name(image.id, image.file.type_extension, image.file.hash)):
+            return await return_default_response(image, request, access)
+    try:
+        async with thumbnail_variants.admit():
+            created = await create_thumbnail_variant(image, size, format)
+        if created:
+            return await run_in_threadpool(return_file_response, image, request, access, size, format)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print_exception(e)
+        raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Could not create thumbnail for this image.")
+    # Bigger in that format than in the image's own.
+    if format:
+        if size == api_settings.thumbnail_default_size:
+            return await return_default_response(image, request, access)
+        return await return_variant_response(image, size, None, request, access)
+    return return_redirect_response(image, request, access)
+
 router = APIRouter(prefix="/thumbnails")
 
 @router.get(
@@ -94,6 +167,9 @@ router = APIRouter(prefix="/thumbnails")
     response_class=FileResponse,
     response_description="Thumbnail.",
     responses={
+        307: {
+            "description": "Thumbnail is being created."
+        },
         308: {
             "description": "Thumbnail isn't available for this image."
         },
@@ -105,50 +181,40 @@ router = APIRouter(prefix="/thumbnails")
         }
     }
 )
-def get_thumbnail(
+async def get_thumbnail(
     id: PyObjectId,
     extension: str,
     request: Request,
-    user: User | None = Depends(get_optional_user)
+    size: int | None = Query(None, description="Fits the thumbnail in `size` x `size`, one of the server's thumbnail sizes. Defaults to the server's default thumbnail size."),
+    access: ImageAccess = Depends(get_image_access)
 ):
-    image_dict = db_images.find_one({
-        "_id": id
-    })
+    if size is None:
+        size = api_settings.thumbnail_default_size
+    elif size not in api_settings.thumbnail_sizes:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=f"Size must be one of: {', '.join(map(str, api_settings.thumbnail_sizes))}.")
 
-    if not image_dict:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Image doesn't exist.")
+    image = await run_in_threadpool(find_image, id)
 
-    image = ImageInDB.parse_obj(image_dict)
+    if not image:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Image doesn't exist.")
 
     if image.lock.is_locked:
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail="Thumbnails are unavailable for this image.")
 
-    if image.is_private and (not user or not compare_digest(image.owner, user.username)):
+    if image.is_private and not access.is_signed and (not access.user or not compare_digest(image.owner, access.user.username)):
         raise HTTPException(status.HTTP_401_UNAUTHORIZED, detail="You don't have permission to view this thumbnail.")
 
     if image.file.type_extension.lstrip(".") != extension:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Wrong file extension.")
 
-    if image.thumbnail.is_computing:
-        return RedirectResponse(request.url_for("get_image_file", id=id, extension=extension), headers={
-             "X-Iamages-Image-Private": str(image.is_private)
-        })
-
-    try:
-        return return_file_response(image)
-    except FileNotFoundError:
-        if not image.thumbnail.is_unavailable:
-            try:
-                if not create_thumbnail(image):
-                    return return_redirect_response(image, request)
-                return return_file_response(image)
-            except Exception as e:
-                print_exception(e)
-                raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Could not create thumbnail for this image.")
-        else:
-            return return_redirect_response(image, request)
-    except Exception as e:
-        print_exception(e)
-        return return_redirect_response(image, request)
-
+    format = get_accepted_format(request, image)
+    cache_headers = {
+        **get_file_cache_headers(image, get_cache_variant(size, format), access.expires),
+        **get_vary_headers()
+    }
+    if is_not_modified(request.headers, cache_headers["ETag"], get_file_last_modified(image)):
+        return not_modified_response(cache_headers)
 
+    if size == api_settings.thumbnail_default_size and not format:
+        return await return_default_response(image, request, access)
+    return await return_variant_response(image, size, format, request, access)
@@ -0,0 +1,222 @@
+import fcntl
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from secrets import compare_digest
+from typing import BinaryIO
+from uuid import UUID
+
+from fastapi import (APIRouter, Depends, Header, HTTPException, Request,
+                     Response, status)
+from starlette.concurrency import run_in_threadpool
+
+from ..common.admission import image_processing
+from ..common.db import db_images, db_upload_sessions
+from ..common.ingest import TEMPORARY_PREFIX, inspect_file
+from ..common.paths import IMAGES_PATH, THUMBNAILS_PATH, UPLOADS_PATH
+from ..common.security import get_optional_user
+from ..common.settings import api_settings
+from ..common.thumbnails import enqueue_thumbnails
+from ..models.images import Image, ImageUpload
+from ..models.uploads import NewUploadSession, UploadSession
+from ..models.users import User
+from .images import (SUPPORTED_MIME_TYPES, check_upload_information,
+                     store_upload)
+
+
+def get_part_path(id: UUID) -> Path:
+    return UPLOADS_PATH / f"{id}.part"
+
+def open_part_file(path: Path) -> BinaryIO:
+    part_file = open(path, "ab")
+    # One chunk at a time, requests at the same offset would otherwise
+    # both pass the offset check and append.
+    try:
+        fcntl.flock(part_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        part_file.close()
+        raise HTTPException(status.HTTP_423_LOCKED, detail="Another chunk is being uploaded to this session.")
+    return part_file
+
+def get_session_in_db(id: UUID, user: User | None) -> UploadSession:
+    session_dict = db_upload_sessions.find_one({"_id": id})
+    if not session_dict:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Upload session doesn't exist or has expired.")
+    session = UploadSession.parse_obj(session_dict)
+    if session.owner and (not user or not compare_digest(session.owner, user.username)):
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, detail="You don't have permission to access this upload session.")
+    return session
+
+def collect_upload_sessions():
+    expiry = datetime.now(timezone.utc) - timedelta(seconds=api_settings.upload_session_ttl)
+    for session_dict in db_upload_sessions.find({"created_on": {"$lt": expiry}}, {"_id": 1}):
+        db_upload_sessions.delete_one({"_id": session_dict["_id"]})
+        get_part_path(session_dict["_id"]).unlink(True)
+    # Leftovers of sessions removed above by another worker, and temporary
+    # files of uploads interrupted by a crash.
+    for path in [
+        *UPLOADS_PATH.iterdir(),
+        *IMAGES_PATH.glob(f"{TEMPORARY_PREFIX}*"),
+        *THUMBNAILS_PATH.glob(f"{TEMPORARY_PREFIX}*")
+    ]:
+        try:
+            if path.stat().st_mtime < expiry.timestamp():
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+router = APIRouter(prefix="/uploads")
+
+@router.post(
+    "/",
+    response_model=UploadSession,
+    response_model_by_alias=False,
+    status_code=status.HTTP_201_CREATED
+)
+def new_upload_session(
+    new_session: NewUploadSession,
+    response: Response,
+    user: User | None = Depends(get_optional_user)
+):
+    if new_session.size > api_settings.max_size:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    if not new_session.content_type in SUPPORTED_MIME_TYPES:
+        raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="We only accept JPEG, PNG, GIF and WebP formats.")
+
+    session = UploadSession(
+        owner=user.username if user else None,
+        content_type=new_session.content_type,
+        size=new_session.size
+    )
+    get_part_path(session.id).touch()
+    db_upload_sessions.insert_one(session.dict(by_alias=True, exclude_none=True))
+
+    response.headers["Upload-Offset"] = "0"
+    return session
+
+@router.head(
+    "/{id}",
+    status_code=status.HTTP_204_NO_CONTENT
+)
+def get_upload_offset(
+    id: UUID,
+    user: User | None = Depends(get_optional_user)
+):
+    session = get_session_in_db(id, user)
+    try:
+        offset = get_part_path(id).stat().st_size
+    except FileNotFoundError:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Upload session doesn't exist or has expired.")
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers={
+        "Upload-Offset": str(offset),
+        "Upload-Length": str(session.size)
+    })
+
+@router.patch(
+    "/{id}",
+    status_code=status.HTTP_204_NO_CONTENT,
+    description="Appends the request body to the upload at the given offset."
+)
+async def upload_chunk(
+    id: UUID,
+    request: Request,
+    upload_offset: int = Header(..., alias="upload-offset"),
+    user: User | None = Depends(get_optional_user)
+):
+    session = await run_in_threadpool(get_session_in_db, id, user)
+    part_path = get_part_path(id)
+    if not part_path.exists():
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Upload session doesn't exist or has expired.")
+
+    part_file = await run_in_threadpool(open_part_file, part_path)
+    try:
+        offset = part_file.tell()
+        if offset != upload_offset:
+            raise HTTPException(status.HTTP_409_CONFLICT, detail="Offset doesn't match the uploaded size.", headers={
+                "Upload-Offset": str(offset)
+            })
+        async for chunk in request.stream():
+            if offset + len(chunk) > session.size:
+                raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, headers={
+                    "Upload-Offset": str(offset)
+                })
+            await run_in_threadpool(part_file.write, chunk)
+            offset += len(chunk)
+    finally:
+        # Also releases the lock.
+        await run_in_threadpool(part_file.close)
+
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers={
+        "Upload-Offset": str(offset)
+    })
+
+@router.post(
+    "/{id}/finalize",
+    response_model=Image,
+    response_model_exclude={
+        "file": {
+            "hash": ...,
+            "salt": ...,
+            "nonce": ...,
+            "tag": ...
+        },
+        "metadata": ...
+    },
+    response_model_by_alias=False,
+    response_model_exclude_unset=True,
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(image_processing)]
+)
+async def finalize_upload(
+    id: UUID,
+    information: ImageUpload,
+    response: Response,
+    user: User | None = Depends(get_optional_user)
+):
+    session = await run_in_threadpool(get_session_in_db, id, user)
+    check_upload_information(information, user)
+
+    part_path = get_part_path(id)
+    try:
+        offset = part_path.stat().st_size
+    except FileNotFoundError:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Upload session doesn't exist or has expired.")
+    if offset != session.size:
+        raise HTTPException(status.HTTP_409_CONFLICT, detail="Upload isn't complete yet.", headers={
+            "Upload-Offset": str(offset)
+        })
+
+    # Claim the session, so that concurrent finalizes and the
+    # collector leave the part file alone from here on.
+    if (await run_in_threadpool(db_upload_sessions.delete_one, {"_id": id})).deleted_count == 0:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Upload session doesn't exist or has expired.")
+
+    ingested = await run_in_threadpool(inspect_file, part_path)
+    image, server_timing = await store_upload(ingested, session.content_type, information, user)
+
+    response.headers["Server-Timing"] = server_timing
+    if image.ownerless_key:
+        response.headers["X-Iamages-Ownerless-Key"] = str(image.ownerless_key)
+
+    await run_in_threadpool(
+        db_images.insert_one,
+        image.dict(by_alias=True, exclude_none=True, exclude={
+            "created_on": ...,
+            "lock": {"upgradable": ...}
+        })
+    )
+    if image.thumbnail:
+        await run_in_threadpool(enqueue_thumbnails, [image.id])
+
+    return image.dict()
+
+@router.delete(
+    "/{id}",
+    status_code=status.HTTP_204_NO_CONTENT
+)
+def delete_upload_session(
+    id: UUID,
+    user: User | None = Depends(get_optional_user)
+):
+    get_session_in_db(id, user)
+    db_upload_sessions.delete_one({"_id": id})
+    get_part_path(id).unlink(True)
@@ -15,12 +15,18 @@ from pydantic.errors import EmailError
 from pymongo import DESCENDING
 from pymongo.errors import DuplicateKeyError
 
+from ..common.admission import password_hashing
+from ..common.blobs import release_blob
 from ..common.db import db, db_collections, db_images, db_users
-from ..common.paths import IMAGES_PATH, THUMBNAILS_PATH
+from ..common.image_cache import invalidate_images
+from ..common.paths import IMAGES_PATH, get_image_file_name
 from ..common.security import (ACCESS_TOKEN_EXPIRE_MINUTES, JWT_ALGORITHM,
                                get_user)
 from ..common.settings import api_settings
+from ..common.storage import storage
 from ..common.templates import templates
+from ..common.thumbnail_cache import delete_thumbnails
+from ..common.user_cache import invalidate_user
 from ..models.collections import Collection
 from ..models.images import Image
 from ..models.pagination import Pagination
@@ -32,13 +38,18 @@ db_password_resets = db.password_resets
 
 def perform_user_delete(username: str):
     db_users.delete_one({"_id": username})
-    image_ids = db_images.find({"owner": username}, {"_id": 1, "file.type_extension": 1})
+    invalidate_user(username)
+    image_ids = db_images.find({"owner": username}, {"_id": 1, "file.type_extension": 1, "file.hash": 1})
     for image_dict in image_ids:
         id = image_dict["_id"]
         db_images.delete_one({"_id": id})
-        filename = f"{id}{image_dict['file']['type_extension']}"
-        (IMAGES_PATH / filename).unlink(True)
-        (THUMBNAILS_PATH / filename).unlink(True)
+        invalidate_images([id])
+        if "hash" in image_dict["file"]:
+            release_blob(image_dict["file"]["hash"], image_dict["file"]["type_extension"])
+            continue
+        filename = get_image_file_name(id, image_dict["file"]["type_extension"])
+        storage.delete(IMAGES_PATH, filename)
+        delete_thumbnails(filename)
     db_collections.delete_many({"owner": username})
 
 crypt_context = CryptContext(schemes=["argon2"], deprecated=["auto"])
@@ -48,7 +59,8 @@ router = APIRouter(prefix="/users")
     "/",
     response_model=User,
     response_model_by_alias=False,
-    status_code=status.HTTP_201_CREATED
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(password_hashing)]
 )
 def new_user(
     username: str = Body(min_length=3),
@@ -69,6 +81,8 @@ def new_user(
     user_dict = user.dict(by_alias=True, exclude_none=True)
     
     db_users.insert_one(user_dict)
+    # Tokens of a deleted user by the same name might be cached as unknown.
+    invalidate_user(username)
 
     return user_dict
 
@@ -84,7 +98,8 @@ def get_user_information(
 
 @router.patch(
     "/",
-    status_code=status.HTTP_204_NO_CONTENT
+    status_code=status.HTTP_204_NO_CONTENT,
+    dependencies=[Depends(password_hashing)]
 )
 def patch_user_information(
     change: EditableUserInformation = Body(...),
@@ -98,6 +113,7 @@ def patch_user_information(
                 db_users.update_one({"_id": user.username}, {
                     "$unset": {"email": 0}
                 })
+                invalidate_user(user.username)
                 return
             # Validate to is email and set new email.
             try:
@@ -109,6 +125,7 @@ def patch_user_information(
                     "email": email
                 }
             })
+            invalidate_user(user.username)
         case EditableUserInformation.password:
             if not to:
                 raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Password not provided.")
@@ -117,6 +134,7 @@ def patch_user_information(
                     "password": crypt_context.hash(to)
                 }
             })
+            invalidate_user(user.username)
 
 @router.delete(
     "/",
@@ -130,7 +148,8 @@ def delete_user(
 
 @router.post(
     "/token",
-    response_model=Token
+    response_model=Token,
+    dependencies=[Depends(password_hashing)]
 )
 def get_user_token(
     form: OAuth2PasswordRequestFormStrict = Depends()
@@ -213,7 +232,8 @@ def get_password_reset_code(
         smtp.send_message(message)
 
 @router.post(
-    "/password/reset"
+    "/password/reset",
+    dependencies=[Depends(password_hashing)]
 )
 def reset_password(
     email: EmailStr = Body(...),
@@ -236,6 +256,7 @@ def reset_password(
             "password": crypt_context.hash(new_password)
         }
     })
+    invalidate_user(user_dict["_id"])
     db_password_resets.delete_one({"_id": email})
 
 @router.post(
@@ -243,6 +264,7 @@ def reset_password(
     response_model=list[Image],
     response_model_exclude={
         "file": {
+            "hash": ...,
             "salt": ...,
             "nonce": ...,
             "tag": ...
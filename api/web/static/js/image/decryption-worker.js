@@ -4,15 +4,15 @@ importScripts(
   "/api/private/static/js/lib/argon2-bundled.min.js"
 );
 
+const SEGMENT_TAG_LENGTH = 16;
+// Lock version deriving both keys from one argon2 hash with HKDF.
+const HKDF_LOCK_VERSION = 3;
+
 function b64decode(b64) {
   return Uint8Array.from(atob(b64), c => c.charCodeAt(0))
 }
 
-function unlock(key, salt, nonce, data, tag) {
-  const alg = {
-    name: "AES-GCM",
-    iv: nonce
-  }
+function hashKey(key, salt) {
   return argon2.hash({
     pass: key,
     salt: salt,
@@ -22,43 +22,120 @@ function unlock(key, salt, nonce, data, tag) {
     hashLen: 16,
     type: argon2.ArgonType.Argon2id
   })
-  .then(h =>  crypto.subtle.importKey("raw", h.hash, alg, false, ["decrypt"]))
-  .then(key => {
-    // Prepare ciphertext
-    let ciphertext = new Uint8Array(data.length + tag.length);
-    ciphertext.set(data);
-    ciphertext.set(tag, data.length);
+  .then(h => h.hash)
+}
 
-    return crypto.subtle.decrypt(alg, key, ciphertext)
-  })
+// Resolves to the metadata and file AES keys.
+async function deriveKeys(key, salt, lockVersion) {
+  const hash = await hashKey(key, salt);
+  if (lockVersion < HKDF_LOCK_VERSION) {
+    const aesKey = await crypto.subtle.importKey("raw", hash, "AES-GCM", false, ["decrypt"]);
+    return {metadata: aesKey, file: aesKey}
+  }
+  const masterKey = await crypto.subtle.importKey("raw", hash, "HKDF", false, ["deriveKey"]);
+  const subkey = info => crypto.subtle.deriveKey(
+    {name: "HKDF", hash: "SHA-256", salt: new Uint8Array(0), info: new TextEncoder().encode(info)},
+    masterKey,
+    {name: "AES-GCM", length: 128},
+    false,
+    ["decrypt"]
+  );
+  return {metadata: await subkey("iamages metadata"), file: await subkey("iamages file")}
+}
+
+function unlock(key, nonce, data, tag) {
+  // Prepare ciphertext
+  let ciphertext = new Uint8Array(data.length + tag.length);
+  ciphertext.set(data);
+  ciphertext.set(tag, data.length);
+
+  return crypto.subtle.decrypt({name: "AES-GCM", iv: nonce}, key, ciphertext)
+}
+
+function segmentNonce(noncePrefix, counter, isLast) {
+  let nonce = new Uint8Array(12);
+  nonce.set(noncePrefix);
+  new DataView(nonce.buffer).setUint32(noncePrefix.length, counter);
+  nonce[11] = isLast ? 1 : 0;
+  return nonce
+}
+
+// Decrypts segmented files while they download, one segment at a time.
+async function unlockSegmented(cryptoKey, noncePrefix, segmentSize, response) {
+  const encryptedSegmentSize = segmentSize + SEGMENT_TAG_LENGTH;
+  const total = Number(response.headers.get("Content-Length"));
+  const reader = response.body.getReader();
+  let parts = [];
+  let buffer = new Uint8Array(0);
+  let received = 0;
+  let counter = 0;
+  let done = false;
+  while (!done) {
+    let chunk;
+    ({done, value: chunk} = await reader.read());
+    if (chunk) {
+      let next = new Uint8Array(buffer.length + chunk.length);
+      next.set(buffer);
+      next.set(chunk, buffer.length);
+      buffer = next;
+      received += chunk.length;
+    }
+    // Hold back one full segment until the end of the stream,
+    // since only then it is known to be the last one.
+    while (buffer.length > encryptedSegmentSize || (done && buffer.length > 0)) {
+      const size = Math.min(encryptedSegmentSize, buffer.length);
+      const isLast = done && size === buffer.length;
+      parts.push(await crypto.subtle.decrypt(
+        {name: "AES-GCM", iv: segmentNonce(noncePrefix, counter++, isLast)},
+        cryptoKey,
+        buffer.subarray(0, size)
+      ));
+      buffer = buffer.slice(size);
+    }
+    if (total) {
+      postMessage({progress: received / total});
+    }
+  }
+  return new Blob(parts)
 }
 
 onmessage = function(e) {
+  const lockVersion = e.data.lockVersion;
   // Decrypted metadata object
   let metadata;
-  // Data for image decryption
-  let imageLock = {}
+  // Metadata and file AES keys
+  let keys;
 
-  unlock(
-    e.data.key,
-    b64decode(e.data.metadata.salt),
+  deriveKeys(e.data.key, b64decode(e.data.metadata.salt), lockVersion)
+  .then(derivedKeys => keys = derivedKeys)
+  .then(() => unlock(
+    keys.metadata,
     b64decode(e.data.metadata.nonce),
     b64decode(e.data.metadata.data),
     b64decode(e.data.metadata.tag)
-  )
+  ))
   .then(raw =>  metadata = JSON.parse(new TextDecoder().decode(raw)))
   .then(() => fetch(e.data.downloadURL))
-  .then(response => {
-    imageLock.salt = b64decode(response.headers.get("X-Iamages-Lock-Salt"));
-    imageLock.nonce = b64decode(response.headers.get("X-Iamages-Lock-Nonce"));
-    imageLock.tag = b64decode(response.headers.get("X-Iamages-Lock-Tag"));
+  .then(async response => {
+    const salt = b64decode(response.headers.get("X-Iamages-Lock-Salt"));
+    const nonce = b64decode(response.headers.get("X-Iamages-Lock-Nonce"));
+    // Older locks hash the file key with its own salt.
+    const fileKey = lockVersion < HKDF_LOCK_VERSION
+      ? (await deriveKeys(e.data.key, salt, lockVersion)).file
+      : keys.file;
+    const segmentSize = response.headers.get("X-Iamages-Lock-Segment-Size");
+    if (segmentSize) {
+      return unlockSegmented(fileKey, nonce, Number(segmentSize), response)
+    }
+    const tag = b64decode(response.headers.get("X-Iamages-Lock-Tag"));
     return response.arrayBuffer()
+      .then(buffer => unlock(fileKey, nonce, new Uint8Array(buffer), tag))
+      .then(raw => new Blob([raw]))
   })
-  .then(buffer => unlock(e.data.key, imageLock.salt, imageLock.nonce, new Uint8Array(buffer), imageLock.tag))
-  .then(raw => {
+  .then(image => {
     postMessage({
       metadata,
-      image: new Blob([raw])
+      image
     })
   });
-}
\ No newline at end of file
+}
@@ -9,6 +9,10 @@ const unlockErrorSpan = document.getElementById("unlock-error-span");
 
 const worker = new Worker("/api/private/static/js/image/decryption-worker.js");
 worker.onmessage = function(e) {
+  // Segmented images report download progress, which isn't shown here.
+  if (e.data.progress !== undefined) {
+    return;
+  }
   descriptionElement.innerText = e.data.metadata.description;
   infoModal.content.contentType.innerText = e.data.metadata.real_content_type;
   infoModal.content.dimensions.innerText = `${e.data.metadata.width}x${e.data.metadata.height}`;
@@ -34,6 +38,7 @@ unlockButton.onclick = function() {
   worker.postMessage({
     "id": image.id,
     "metadata": image.metadata,
+    "lockVersion": image.lock.version,
     "key": unlockKeyInput.value,
     "downloadURL": downloadURL
   });
@@ -0,0 +1,28 @@
+from argparse import ArgumentParser
+from asyncio import Event, run
+
+from .common.compute import shutdown_executor
+from .common.image_cache import start_invalidation_bus, stop_invalidation_bus
+from .common.settings import api_settings
+from .common.tasks import cancel_tasks, run_periodically
+from .common.thumbnails import run_thumbnail_jobs
+
+async def main(concurrency: int):
+    start_invalidation_bus()
+    try:
+        for _ in range(concurrency):
+            run_periodically(run_thumbnail_jobs, api_settings.thumbnail_job_poll_interval)
+        await Event().wait()
+    finally:
+        cancel_tasks()
+        shutdown_executor()
+        stop_invalidation_bus()
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(description="Runs thumbnail jobs outside of the server, e.g. with IAMAGES_THUMBNAIL_WORKERS=0 for the server.")
+    arg_parser.add_argument("--concurrency", action="store", type=int, default=2, help="Number of thumbnail jobs run at once.")
+    args = arg_parser.parse_args()
+    try:
+        run(main(args.concurrency))
+    except KeyboardInterrupt:
+        pass
@@ -11,7 +11,7 @@ from zipfile import ZipFile
 from shutil import rmtree, copyfileobj
 
 from common.db import db_collections, db_images, db_users
-from common.paths import IMAGES_PATH, THUMBNAILS_PATH
+from common.paths import IMAGES_PATH, THUMBNAILS_PATH, get_file_path
 from models.collections import Collection
 from models.images import (ImageInDB, ImageMetadata, ImageMetadataContainer,
                            Lock, Thumbnail, File)
@@ -109,9 +109,11 @@ with ZipFile(archive_file) as z:
                     }
                 )
             )
+            new_image_path = get_file_path(IMAGES_PATH, f"{image.id}{image.file.type_extension}")
+            new_image_path.parent.mkdir(parents=True, exist_ok=True)
             with (
                 z.open(f"files/{file_dict['file']}", "r") as old_image,
-                open(IMAGES_PATH / f"{image.id}{image.file.type_extension}", "wb") as new_image
+                open(new_image_path, "wb") as new_image
             ):
                 copyfileobj(old_image, new_image)
 print("\nDone! Verify everything has been transfered over.")
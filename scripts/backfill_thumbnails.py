@@ -0,0 +1,183 @@
+__version__ = "4.0.0"
+__copyright__ = "© jkelol111 et al 2023-present"
+
+import asyncio
+import json
+import os
+from argparse import ArgumentParser
+from collections import Counter
+from multiprocessing import get_context
+from pathlib import Path
+from time import monotonic, sleep
+from traceback import format_exception_only
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+from common.db import db_images, db_thumbnail_jobs
+from common.imaging import make_placeholder, make_thumbnail
+from common.ingest import discard_file, new_temporary_path
+from common.paths import (IMAGES_PATH, THUMBNAILS_PATH, get_image_file_name,
+                          get_thumbnail_file_names)
+from common.settings import api_settings
+from common.storage import storage
+from common.thumbnail_cache import thumbnail_index
+
+
+def parse_args():
+    arg_parser = ArgumentParser(description="Creates the thumbnails of stored images in bulk, like after migrating from v3 or changing thumbnail settings, while the server is running.")
+    arg_parser.add_argument("--workers", action="store", type=int, default=os.cpu_count(), help="Number of processes creating thumbnails, defaults to the number of CPUs.")
+    arg_parser.add_argument("--batch-size", action="store", type=int, default=500, help="Images read from the database at once, progress is saved after each batch.")
+    arg_parser.add_argument("--rate", action="store", type=float, default=0, help="Most images started per second, 0 for no limit.")
+    arg_parser.add_argument("--nice", action="store", type=int, default=10, help="Niceness of the worker processes, so the server comes first.")
+    arg_parser.add_argument("--regenerate", action="store_true", help="Also recreate existing thumbnails, dropping their other sizes and formats.")
+    arg_parser.add_argument("--checkpoint", action="store", type=Path, default=Path(api_settings.storage_dir, ".thumbnail-backfill.json"), help="File progress is saved to and resumed from.")
+    arg_parser.add_argument("--restart", action="store_true", help="Ignore the saved progress and start from the first image.")
+    return arg_parser.parse_args()
+
+def init_worker(nice: int):
+    os.nice(nice)
+
+async def create_thumbnail(file_name: str, regenerate: bool, has_placeholder: bool) -> tuple[str, tuple[str, str] | None]:
+    # Deduplicated images share their thumbnail.
+    if not regenerate and storage.exists(THUMBNAILS_PATH, file_name):
+        if has_placeholder:
+            return "exists", None
+        async with storage.open_local(THUMBNAILS_PATH, file_name) as thumbnail_path:
+            return "exists", make_placeholder(thumbnail_path)
+    thumbnail_path = new_temporary_path(THUMBNAILS_PATH)
+    try:
+        async with storage.open_local(IMAGES_PATH, file_name) as file_path:
+            if not make_thumbnail(file_path, thumbnail_path, api_settings.thumbnail_default_size):
+                return "unavailable", make_placeholder(file_path)
+        placeholder = make_placeholder(thumbnail_path)
+        storage.put(thumbnail_path, THUMBNAILS_PATH, file_name)
+    finally:
+        discard_file(thumbnail_path)
+    return "created", placeholder
+
+def run_task(task: tuple[ObjectId, str, bool, bool]) -> tuple[ObjectId, str, tuple[str, str] | None, str | None]:
+    id, file_name, regenerate, has_placeholder = task
+    try:
+        return id, *asyncio.run(create_thumbnail(file_name, regenerate, has_placeholder)), None
+    except Exception as e:
+        return id, "failed", None, "".join(format_exception_only(e)).strip()
+
+def limit_rate(tasks: list, rate: float):
+    # Paces the tasks handed to the pool rather than the workers.
+    started_on = monotonic()
+    for index, task in enumerate(tasks):
+        if rate > 0:
+            delay = started_on + index / rate - monotonic()
+            if delay > 0:
+                sleep(delay)
+        yield task
+
+def read_checkpoint(path: Path) -> tuple[ObjectId | None, Counter]:
+    try:
+        checkpoint = json.loads(path.read_text())
+    except FileNotFoundError:
+        return None, Counter()
+    return ObjectId(checkpoint["last_id"]), Counter(checkpoint["counts"])
+
+def write_checkpoint(path: Path, last_id: ObjectId, counts: Counter):
+    temporary_path = path.with_name(path.name + ".tmp")
+    temporary_path.write_text(json.dumps({"last_id": str(last_id), "counts": counts}))
+    temporary_path.replace(path)
+
+def record_results(results: list[tuple[ObjectId, str, tuple[str, str] | None, str | None]], file_names: dict[ObjectId, str], regenerate: bool):
+    created = [id for id, result, _, _ in results if result in ("created", "exists")]
+    unavailable = [id for id, result, _, _ in results if result == "unavailable"]
+    if created:
+        db_images.update_many({"_id": {"$in": created}}, {"$set": {"thumbnail.is_unavailable": False}})
+    if unavailable:
+        db_images.update_many({"_id": {"$in": unavailable}}, {"$set": {"thumbnail.is_unavailable": True}})
+    placeholders = [
+        UpdateOne({"_id": id}, {"$set": {"thumbnail.placeholder": placeholder[0], "thumbnail.color": placeholder[1]}})
+        for id, _, placeholder, _ in results if placeholder
+    ]
+    if placeholders:
+        db_images.bulk_write(placeholders, ordered=False)
+    # Done already, unless a server is running them right now.
+    db_thumbnail_jobs.delete_many({"_id": {"$in": created + unavailable}, "state": {"$ne": "running"}})
+    if regenerate:
+        # Other sizes and formats were made from the old thumbnail.
+        for id, result, _, _ in results:
+            if result == "created":
+                variant_file_names = get_thumbnail_file_names(file_names[id])
+                variant_file_names.remove(file_names[id])
+                for variant_file_name in variant_file_names:
+                    storage.delete(THUMBNAILS_PATH, variant_file_name)
+                thumbnail_index.remove(variant_file_names)
+
+def main():
+    args = parse_args()
+    print(f"[Iamages Thumbnail Backfill v{__version__} - {__copyright__}]")
+
+    last_id, counts = (None, Counter()) if args.restart else read_checkpoint(args.checkpoint)
+    if last_id:
+        print(f"Resuming after image {last_id}, {sum(counts.values())} done before.")
+
+    query = {
+        "lock.is_locked": False,
+        "thumbnail": {"$ne": None},
+        # Being created by the server.
+        "thumbnail.is_computing": {"$ne": True}
+    }
+    if not args.regenerate:
+        query["thumbnail.is_unavailable"] = {"$ne": True}
+
+    # Spawned, since forking would copy the database client.
+    with get_context("spawn").Pool(args.workers, initializer=init_worker, initargs=(args.nice,)) as pool:
+        started_on = monotonic()
+        run_count = 0
+        while True:
+            batch_query = {**query, "_id": {"$gt": last_id}} if last_id else query
+            image_dicts = list(db_images.find(batch_query, {"file": 1, "thumbnail": 1}).sort("_id", 1).limit(args.batch_size))
+            if not image_dicts:
+                break
+
+            has_placeholders = {image_dict["_id"]: bool(image_dict["thumbnail"].get("placeholder")) for image_dict in image_dicts}
+            file_names = {
+                image_dict["_id"]: get_image_file_name(image_dict["_id"], image_dict["file"]["type_extension"], image_dict["file"].get("hash"))
+                for image_dict in image_dicts
+            }
+            # Deduplicated images share their file, the placeholder is
+            # made once for all of them if any lacks one.
+            file_has_placeholders = {}
+            for id, file_name in file_names.items():
+                file_has_placeholders[file_name] = file_has_placeholders.get(file_name, True) and has_placeholders[id]
+            tasks, duplicates, results, seen = [], [], [], set()
+            for id, file_name in file_names.items():
+                # Once per deduplicated file.
+                if file_name in seen:
+                    duplicates.append(id)
+                    continue
+                seen.add(file_name)
+                tasks.append((id, file_name, args.regenerate, file_has_placeholders[file_name]))
+
+            file_results = {}
+            for id, result, placeholder, error in pool.imap_unordered(run_task, limit_rate(tasks, args.rate)):
+                results.append((id, result, None if has_placeholders[id] else placeholder, error))
+                file_results[file_names[id]] = result, placeholder
+                if error:
+                    print(f"{id}: {error}")
+            for id in duplicates:
+                result, placeholder = file_results[file_names[id]]
+                results.append((id, result, None if has_placeholders[id] else placeholder, None))
+            record_results(results, file_names, args.regenerate)
+
+            last_id = image_dicts[-1]["_id"]
+            counts.update(result for _, result, _, _ in results)
+            write_checkpoint(args.checkpoint, last_id, counts)
+            run_count += len(results)
+            print(f"{run_count / (monotonic() - started_on):.1f} images/s, {dict(counts)}, last image {last_id}")
+
+    thumbnail_index.flush()
+    args.checkpoint.unlink(True)
+    print(f"Done! {dict(counts)}")
+    if counts["failed"]:
+        print("Failed images are left to the server's thumbnail jobs, or run again with --restart to retry them.")
+
+if __name__ == "__main__":
+    main()
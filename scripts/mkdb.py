@@ -4,7 +4,7 @@ __copyright__ = "© jkelol111 et al 2023-present"
 from getpass import getpass
 from urllib.parse import quote
 
-from pymongo import MongoClient, TEXT, DESCENDING
+from pymongo import MongoClient, TEXT, ASCENDING, DESCENDING
 
 from models.db import DatabaseVersionModel
 
@@ -41,6 +41,10 @@ db.users.create_index([("email", TEXT)], sparse=True)
 
 db.password_resets.create_index("created_on", expireAfterSeconds=900)
 
+db.upload_sessions.create_index("created_on")
+
+db.thumbnail_jobs.create_index([("state", ASCENDING), ("available_on", ASCENDING)])
+
 # Add database version upgrade record.
 db.internal.insert_one(DatabaseVersionModel().dict())
 
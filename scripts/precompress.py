@@ -0,0 +1,34 @@
+__version__ = "4.0.0"
+__copyright__ = "© jkelol111 et al 2023-present"
+
+import gzip
+from argparse import ArgumentParser
+from pathlib import Path
+
+import brotli
+
+COMPRESSIBLE_SUFFIXES = {".css", ".js", ".html", ".svg", ".json", ".txt", ".map"}
+
+arg_parser = ArgumentParser(description="Writes Brotli and gzip compressed copies of the static web assets, sent in their place to clients accepting them.")
+arg_parser.add_argument("--directory", action="store", type=Path, default=Path(__file__).resolve().parent.parent / "api" / "web" / "static", help="Static assets directory.")
+args = arg_parser.parse_args()
+
+print(f"[Iamages Static Precompressor v{__version__} - {__copyright__}]")
+
+for path in sorted(args.directory.rglob("*")):
+    if path.suffix not in COMPRESSIBLE_SUFFIXES or not path.is_file():
+        continue
+    data = path.read_bytes()
+    for suffix, compressed in (
+        (".br", brotli.compress(data, quality=11)),
+        (".gz", gzip.compress(data, compresslevel=9, mtime=0))
+    ):
+        compressed_path = path.with_name(path.name + suffix)
+        # Not worth sending instead of the original.
+        if len(compressed) >= len(data):
+            compressed_path.unlink(True)
+            continue
+        compressed_path.write_bytes(compressed)
+        print(f"{compressed_path.relative_to(args.directory)}: {len(data)} -> {len(compressed)} bytes")
+
+print("Done! Run again whenever the static assets change, outdated copies aren't sent.")
@@ -0,0 +1,89 @@
+__version__ = "4.0.0"
+__copyright__ = "© jkelol111 et al 2023-present"
+
+import os
+from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+
+from common.paths import IMAGES_PATH, THUMBNAILS_PATH, get_file_path
+from common.settings import api_settings
+
+arg_parser = ArgumentParser(description="Moves stored images and thumbnails into the layout set by IAMAGES_STORAGE_FANOUT, while the server is running.")
+arg_parser.add_argument("--workers", action="store", type=int, default=8, help="Number of threads moving files.")
+arg_parser.add_argument("--dry-run", action="store_true", help="Only count the files that would be moved.")
+args = arg_parser.parse_args()
+
+print(f"[Iamages Storage Resharder v{__version__} - {__copyright__}]")
+
+counts = Counter()
+counts_lock = Lock()
+
+def count(result: str):
+    with counts_lock:
+        counts[result] += 1
+        if sum(counts.values()) % 10000 == 0:
+            print(f"{dict(counts)}")
+
+def move_file(root: Path, path: Path) -> str:
+    target = get_file_path(root, path.name)
+    if target == path:
+        return "in place"
+    if args.dry_run:
+        return "to move"
+    target.parent.mkdir(parents=True, exist_ok=True)
+    # Link before unlinking, so the file is always reachable by the server
+    # (which looks in every layout) and nothing is lost when interrupted.
+    try:
+        os.link(path, target)
+    except FileExistsError:
+        # Either linked by an interrupted run, or written in the new layout
+        # by the server since, which makes the old copy stale.
+        if not os.path.samefile(path, target):
+            path.unlink(True)
+            return "stale"
+    path.unlink(True)
+    return "moved"
+
+def move_files(root: Path, paths: list[Path]):
+    for path in paths:
+        try:
+            count(move_file(root, path))
+        except FileNotFoundError:
+            # Deleted by the server meanwhile.
+            count("gone")
+
+def reshard(executor: ThreadPoolExecutor, root: Path):
+    # Directories are listed here while the workers move files in batches.
+    futures = []
+    pending_directories = [root]
+    while pending_directories:
+        batch = []
+        with os.scandir(pending_directories.pop()) as entries:
+            for entry in entries:
+                # Temporary files and other server state.
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending_directories.append(Path(entry.path))
+                elif entry.is_file(follow_symlinks=False):
+                    batch.append(Path(entry.path))
+                    if len(batch) == 1000:
+                        futures.append(executor.submit(move_files, root, batch))
+                        batch = []
+        if batch:
+            futures.append(executor.submit(move_files, root, batch))
+    for future in futures:
+        future.result()
+
+print(f"Target layout: {api_settings.storage_fanout} level(s) of fan-out.")
+with ThreadPoolExecutor(args.workers) as executor:
+    for root in (IMAGES_PATH, THUMBNAILS_PATH):
+        print(f"Resharding {root}")
+        reshard(executor, root)
+
+print(f"Done! {dict(counts)}")
+# Listing a directory while files move in and out of it can miss some.
+print("Run again until nothing is moved. It's safe to interrupt and run again at any time.")
@@ -0,0 +1,13 @@
+import os
+from tempfile import mkdtemp
+
+# Required settings, enough to import the modules under test.
+os.environ.setdefault("iamages_db_url", "mongodb://localhost")
+os.environ.setdefault("iamages_storage_dir", mkdtemp())
+os.environ.setdefault("iamages_jwt_secret", "test")
+os.environ.setdefault("iamages_server_owner", "test")
+os.environ.setdefault("iamages_server_contact", "test")
+os.environ.setdefault("iamages_smtp_host", "localhost")
+os.environ.setdefault("iamages_smtp_port", "25")
+os.environ.setdefault("iamages_smtp_starttls", "false")
+os.environ.setdefault("iamages_smtp_from", "test@example.com")
@@ -0,0 +1,31 @@
+import asyncio
+import os
+import signal
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from api.common import compute
+
+
+@pytest.fixture(autouse=True)
+def executor():
+    yield
+    compute.shutdown_executor()
+
+def test_recovers_after_child_is_killed():
+    async def run():
+        pid = await compute.run_in_process(os.getpid)
+        broken_executor = compute.get_executor()
+        os.kill(pid, signal.SIGKILL)
+        assert await compute.run_in_process(abs, -1) == 1
+        assert compute.get_executor() is not broken_executor
+    asyncio.run(run())
+
+def test_recovers_after_call_kills_child():
+    async def run():
+        # Kills the child it runs in, and the one it's retried in.
+        with pytest.raises(BrokenProcessPool):
+            await compute.run_in_process(os._exit, 1)
+        assert await compute.run_in_process(abs, -1) == 1
+    asyncio.run(run())